@@ -0,0 +1,39 @@
+"""
+Skin cancer classification of the HAM10000 images with TensorFlow.
+
+Importing the package is cheap. The modules are imported when one of their names is first used,
+e.g. skin_cancer.preprocess_img only imports the preprocessing module and TensorFlow.
+tensorflow_hub, tensorflowjs, matplotlib and seaborn are only imported by the functions and modules which use them.
+The cli is run with python -m skin_cancer.
+"""
+
+import importlib
+
+# public names and their modules
+_EXPORTS = {
+    "CLASSES": "config", "CLASSNAMES": "config", "DATA_ROOT": "config", "data_paths": "config",
+    "load_metadata": "data", "prepare_data": "data", "load_or_create_split": "data", "rebalance": "data",
+    "preprocess_img": "preprocessing", "decode_img": "preprocessing", "augment_batch": "preprocessing",
+    "create_batches": "pipeline", "create_sampled_batches": "pipeline", "create_train_data": "pipeline",
+    "build_store": "pipeline", "load_store": "pipeline",
+    "create_model": "models", "create_custom_model": "models", "load_model": "models",
+    "ModelRegistry": "registry", "get_model": "registry",
+    "compute_metrics": "metrics", "MetricsAccumulator": "metrics",
+    "train_model": "training", "save_model": "training", "train_head": "embeddings",
+    "profile_training": "profiling", "run_sweep": "sweep",
+    "evaluate_model": "evaluation", "predict_directory": "prediction", "PredictionCache": "prediction_cache",
+    "export_tflite": "export", "export_tfjs": "export", "TFLitePredictor": "tflite",
+    "load_tfjs_model": "tfjs_model", "serve_model": "serving",
+}
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+  if name not in _EXPORTS:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  value = getattr(importlib.import_module(f"{__name__}.{_EXPORTS[name]}"), name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,5 @@
+from skin_cancer.cli import main
+
+# guarded, since the worker processes of a sweep import the main module
+if __name__ == "__main__":
+  main()
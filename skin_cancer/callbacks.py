@@ -0,0 +1,120 @@
+"""
+Tensorboard, early stopping and checkpoint callbacks of the training.
+Every CHECKPOINT_EVERY epochs the weights, optimizer state, epoch, global random generator and early stopping state are saved,
+only the latest MAX_CHECKPOINTS are kept. The training batches are indexed by epoch, so the epoch is also the position of the data iterator.
+The prepare_data dict, its filepaths and labels after splitting and balancing, is saved next to the checkpoints.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from skin_cancer.config import PATHS
+
+LOG_DIR = PATHS["logs"]
+
+def create_tensorboard_callback(profile_batch=0, log_dir=LOG_DIR):
+  """Returns a tensorboard callback with a new log directory, profile_batch=(start, stop) traces these steps"""
+  logdir = os.path.join(log_dir,
+                        datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+  return tf.keras.callbacks.TensorBoard(logdir, profile_batch=profile_batch)
+
+# early stopping
+PATIENCE = 25
+
+class ResumableEarlyStopping(tf.keras.callbacks.EarlyStopping):
+  """Early stopping which continues with the wait count and best value of a resumed training"""
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.resumed_state = None
+
+  def on_train_begin(self, logs=None):
+    super().on_train_begin(logs)
+    if self.resumed_state is not None:
+      self.wait, best = self.resumed_state
+      if best is not None:
+        self.best = best
+
+def create_early_stopping(patience=PATIENCE):
+  """Returns the early stopping callback of the validation accuracy"""
+  return ResumableEarlyStopping(monitor="val_accuracy", mode="max", patience=patience)
+
+CHECKPOINT_DIR = PATHS["checkpoints"]
+CHECKPOINT_EVERY = 1
+MAX_CHECKPOINTS = 3
+TRAINING_DATA_FILE = "training_data.npz"
+
+def create_checkpoint(model, checkpoint_dir=CHECKPOINT_DIR, max_to_keep=MAX_CHECKPOINTS):
+  """Returns the checkpoint of the training state of the compiled model and its manager"""
+  # create the optimizer variables now, so they are restored right away
+  model.optimizer.build(model.trainable_variables)
+  checkpoint = tf.train.Checkpoint(model=model,
+                                   optimizer=model.optimizer,
+                                   epoch=tf.Variable(0, dtype=tf.int64),
+                                   rng=tf.random.get_global_generator(),
+                                   early_stopping_wait=tf.Variable(0, dtype=tf.int64),
+                                   early_stopping_best=tf.Variable(np.nan, dtype=tf.float64))
+  manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=max_to_keep)
+  return checkpoint, manager
+
+def restore_checkpoint(checkpoint, manager, early_stopping):
+  """Restores the latest checkpoint and returns the epoch to continue with (0 without a checkpoint)"""
+  if manager.latest_checkpoint is None:
+    early_stopping.resumed_state = None
+    return 0
+  checkpoint.restore(manager.latest_checkpoint).assert_existing_objects_matched()
+  best = float(checkpoint.early_stopping_best.numpy())
+  early_stopping.resumed_state = (int(checkpoint.early_stopping_wait.numpy()), None if np.isnan(best) else best)
+  epoch = int(checkpoint.epoch.numpy())
+  print(f"Resumed from {manager.latest_checkpoint} at epoch {epoch}")
+  return epoch
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+  """Saves the training state of the checkpoint every `every` epochs"""
+  def __init__(self, checkpoint, manager, early_stopping, every=CHECKPOINT_EVERY):
+    super().__init__()
+    self.checkpoint = checkpoint
+    self.manager = manager
+    self.every = every
+    self.early_stopping = early_stopping
+
+  def on_epoch_end(self, epoch, logs=None):
+    if (epoch + 1) % self.every:
+      return
+    self.checkpoint.epoch.assign(epoch + 1)
+    self.checkpoint.early_stopping_wait.assign(self.early_stopping.wait)
+    best = self.early_stopping.best
+    self.checkpoint.early_stopping_best.assign(np.nan if best is None else best)
+    self.manager.save(checkpoint_number=epoch + 1)
+
+def worker_checkpoint_dir(strategy, checkpoint_dir=CHECKPOINT_DIR):
+  """Returns checkpoint_dir for the chief and an own subdirectory for every other worker of a multi worker strategy"""
+  resolver = getattr(strategy, "cluster_resolver", None)
+  if resolver is None or resolver.task_type is None:
+    return checkpoint_dir
+  has_chief = "chief" in resolver.cluster_spec().jobs
+  if resolver.task_type == "chief" or (not has_chief and resolver.task_id == 0):
+    return checkpoint_dir
+  return os.path.join(checkpoint_dir, f"{resolver.task_type}{resolver.task_id}")
+
+def save_training_data(training_data, checkpoint_dir=CHECKPOINT_DIR):
+  """Saves the filepaths, labels, balancing and balance targets of the prepare_data dict next to the checkpoints"""
+  os.makedirs(checkpoint_dir, exist_ok=True)
+  np.savez(os.path.join(checkpoint_dir, TRAINING_DATA_FILE),
+           balancing=training_data["balancing"],
+           balance_targets=json.dumps(training_data["balance_targets"]),
+           **{name: values for name, values in training_data.items() if name.startswith(("X_", "y_"))})
+
+def load_training_data(checkpoint_dir=CHECKPOINT_DIR):
+  """Returns the prepare_data dict saved in checkpoint_dir or None"""
+  path = os.path.join(checkpoint_dir, TRAINING_DATA_FILE)
+  if not os.path.exists(path):
+    return None
+  saved = np.load(path)
+  training_data = {name: saved[name] for name in saved.files}
+  training_data["balancing"] = str(training_data["balancing"])
+  training_data["balance_targets"] = json.loads(str(training_data["balance_targets"]))
+  return training_data
@@ -0,0 +1,194 @@
+"""
+Command line interface, run with python -m skin_cancer <command>.
+
+  prepare   split the metadata and optionally build the preprocessed image store
+  train     train the transfer or custom model, or only the dense head on cached embeddings
+  evaluate  evaluate a trained model on the validation or test images
+  predict   write the class probabilities of a directory of images to a csv
+  export    export a trained model to tflite or tfjs
+  sweep     search hyperparameters with successive halving on a process pool
+
+The dataset files and outputs are read from and written below --data-root.
+Every command imports the modules it needs when it runs, so the cli starts without TensorFlow
+and predict never imports tensorflow_hub (except for hub models), tensorflowjs or matplotlib.
+"""
+
+import argparse
+import json
+
+from skin_cancer.config import DATA_ROOT, data_paths
+
+def optional(args, *names):
+  """Returns the options of names which were given on the command line, the others keep the defaults of the package"""
+  return {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+def load_training_data(args, paths):
+  """Returns the prepare_data dict of the metadata below the data root"""
+  from skin_cancer.data import load_metadata, prepare_data
+  return prepare_data(load_metadata(paths["metadata"]), paths["images"], split_path=paths["split"],
+                      **optional(args, "size", "balancing"))
+
+def load_cli_model(args, batch_size):
+  """Returns the model of args.model in the format of its extension (or directory)"""
+  from skin_cancer.registry import detect_format, load_model_file
+  model_format = detect_format(args.model)
+  if model_format == "tflite" and args.tta and args.tta > 1:
+    raise SystemExit("Test time augmentation needs a keras model")
+  return load_model_file(args.model, model_format, args.custom, batch_size)
+
+def prepare(args):
+  paths = data_paths(args.data_root)
+  training_data = load_training_data(args, paths)
+  print(f"Train: {len(training_data['X_train'])}, validation: {len(training_data['X_val'])}, "
+        f"test: {len(training_data['X_test'])} images")
+  if args.store:
+    from skin_cancer.data import load_metadata
+    from skin_cancer.pipeline import build_store
+    build_store(load_metadata(paths["metadata"]), paths["images"], paths["store"])
+
+def train(args):
+  paths = data_paths(args.data_root)
+  options = optional(args, "epochs", "patience")
+  if args.head:
+    from skin_cancer.embeddings import train_head
+    training_data = load_training_data(args, paths)
+    model = train_head(training_data, cache_dir=paths["embeddings"], log_dir=paths["logs"], **options)
+  else:
+    from skin_cancer.callbacks import load_training_data as load_checkpoint_data
+    from skin_cancer.training import train_model
+    checkpoint_dir = args.checkpoint_dir or paths["checkpoints"]
+    # continue an interrupted training with its training data instead of splitting and balancing again
+    training_data = load_checkpoint_data(checkpoint_dir)
+    if training_data is None:
+      training_data = load_training_data(args, paths)
+    else:
+      print(f"Using the training data of {checkpoint_dir}")
+    model = train_model(training_data, custom=args.custom, checkpoint_dir=checkpoint_dir, profile=args.profile,
+                        log_dir=paths["logs"], **options)
+  from skin_cancer.training import save_model
+  save_model(model, suffix=args.suffix or ("head" if args.head else "custom" if args.custom else "resnet"),
+             model_dir=paths["models"])
+
+def evaluate(args):
+  from skin_cancer.config import BATCH_SIZE
+  from skin_cancer.evaluation import evaluate_model
+  from skin_cancer.pipeline import create_batches
+  paths = data_paths(args.data_root)
+  training_data = load_training_data(args, paths)
+  model = load_cli_model(args, BATCH_SIZE)
+  data = create_batches(training_data[f"X_{args.subset}"], training_data[f"y_{args.subset}"], valid_data=True)
+  results = evaluate_model(model, data, keep_probabilities=False, **optional(args, "tta"))
+  results = {name: value.tolist() if hasattr(value, "tolist") else value for name, value in results.items()}
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+    print(f"Saved metrics to {args.output}")
+
+def predict(args):
+  from skin_cancer.prediction import PREDICT_BATCH_SIZE, predict_directory
+  paths = data_paths(args.data_root)
+  batch_size = args.batch_size or PREDICT_BATCH_SIZE
+  model = load_cli_model(args, batch_size)
+  cache = None
+  if args.cache:
+    from skin_cancer.prediction_cache import PredictionCache
+    cache = PredictionCache(paths["prediction_cache"], **optional(args, "max_mb"))
+  predict_directory(model, args.images or paths["test_images"], args.output or paths["predictions"],
+                    batch_size, resume=not args.overwrite, cache=cache, **optional(args, "tta"))
+
+def export(args):
+  from skin_cancer.export import export_tfjs, export_tflite
+  from skin_cancer.models import load_model
+  paths = data_paths(args.data_root)
+  model = load_model(args.model, custom=args.custom)
+  if args.format == "tfjs":
+    export_tfjs(model, args.output or paths["models"])
+    return
+  calibration_images = None
+  if args.quantization == "int8":
+    calibration_images = load_training_data(args, paths)[f"X_{args.calibration}"]
+  export_tflite(model, args.output or "scc_model.tflite", args.quantization, calibration_images)
+
+def sweep(args):
+  from skin_cancer.data import load_metadata
+  from skin_cancer.sweep import SEARCH_SPACE, run_sweep
+  paths = data_paths(args.data_root)
+  search_space = SEARCH_SPACE
+  if args.space:
+    # json has no tuples, the filters of the custom model are lists in the file
+    with open(args.space) as f:
+      search_space = {name: [tuple(value) if isinstance(value, list) else value for value in values]
+                      for name, values in json.load(f).items()}
+  report = run_sweep(load_metadata(paths["metadata"]), paths["images"], search_space, split_path=paths["split"],
+                     sweep_dir=paths["sweeps"],
+                     **optional(args, "num_trials", "num_rungs", "eta", "threads_per_trial", "num_workers"))
+  print(report.to_string(index=False))
+
+def create_parser():
+  """Returns the argument parser of the commands"""
+  common = argparse.ArgumentParser(add_help=False)
+  common.add_argument("--data-root", default=DATA_ROOT,
+                      help="directory of the metadata, images and outputs (default: %(default)s, "
+                           "or the SKIN_CANCER_DATA_ROOT environment variable)")
+  data = argparse.ArgumentParser(add_help=False)
+  data.add_argument("--size", type=int, help="number of images of the dataset to use")
+  data.add_argument("--balancing", choices=["copy", "weights", "rejection"], help="class balancing of the training data")
+  model = argparse.ArgumentParser(add_help=False)
+  model.add_argument("model", help="trained .h5 or .keras model (also SavedModel, .tflite or tfjs for evaluate and predict)")
+  model.add_argument("--custom", action="store_true", help="the model is the custom model, not a hub model")
+
+  parser = argparse.ArgumentParser(prog="python -m skin_cancer", description="Skin cancer classification")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  command = commands.add_parser("prepare", parents=[common, data], help="split the metadata")
+  command.add_argument("--store", action="store_true", help="also build the preprocessed image store")
+  command.set_defaults(func=prepare)
+
+  command = commands.add_parser("train", parents=[common, data], help="train a model")
+  command.add_argument("--custom", action="store_true", help="train the custom model instead of the hub model")
+  command.add_argument("--head", action="store_true", help="only train the dense head on cached embeddings")
+  command.add_argument("--epochs", type=int)
+  command.add_argument("--patience", type=int)
+  command.add_argument("--profile", action="store_true", help="write a profile summary and trace to the logs")
+  command.add_argument("--checkpoint-dir", help="resume from and save checkpoints to this directory")
+  command.add_argument("--suffix", help="suffix of the saved model file")
+  command.set_defaults(func=train)
+
+  command = commands.add_parser("evaluate", parents=[common, data, model], help="evaluate a trained model")
+  command.add_argument("--subset", choices=["val", "test"], default="val")
+  command.add_argument("--tta", type=int, help="number of test time augmentation views")
+  command.add_argument("--output", help="json file of the metrics")
+  command.set_defaults(func=evaluate)
+
+  command = commands.add_parser("predict", parents=[common, model], help="predict a directory of images")
+  command.add_argument("images", nargs="?", help="directory of jpg images (default: test_data of the data root)")
+  command.add_argument("--output", help="prediction csv (default: test_predictions.csv of the data root)")
+  command.add_argument("--batch-size", type=int)
+  command.add_argument("--tta", type=int, help="number of test time augmentation views")
+  command.add_argument("--overwrite", action="store_true", help="predict all images instead of resuming the csv")
+  command.add_argument("--cache", action="store_true",
+                       help="reuse the predictions of images seen before from the prediction cache of the data root")
+  command.add_argument("--max-cache-mb", dest="max_mb", type=float, help="size limit of the prediction cache")
+  command.set_defaults(func=predict)
+
+  command = commands.add_parser("export", parents=[common, data, model], help="export a trained model")
+  command.add_argument("--format", choices=["tflite", "tfjs"], default="tflite")
+  command.add_argument("--quantization", choices=["dynamic", "float16", "int8"], help="tflite quantization")
+  command.add_argument("--calibration", choices=["val", "train", "test"], default="val",
+                       help="split whose images calibrate int8, the validation images of the quantization report by default")
+  command.add_argument("--output", help="tflite file or tfjs directory")
+  command.set_defaults(func=export)
+
+  command = commands.add_parser("sweep", parents=[common], help="search hyperparameters")
+  command.add_argument("--space", help="json file of parameter names and their values (default: SEARCH_SPACE)")
+  command.add_argument("--trials", dest="num_trials", type=int)
+  command.add_argument("--rungs", dest="num_rungs", type=int, help="number of successive halving rounds")
+  command.add_argument("--eta", type=int, help="the best 1/eta of the trials continue after every rung")
+  command.add_argument("--threads-per-trial", type=int)
+  command.add_argument("--workers", dest="num_workers", type=int, help="parallel trials (default: cores / threads)")
+  command.set_defaults(func=sweep)
+  return parser
+
+def main(argv=None):
+  args = create_parser().parse_args(argv)
+  args.func(args)
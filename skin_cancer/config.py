@@ -0,0 +1,46 @@
+"""
+Settings shared by the modules of the package.
+All dataset files and training outputs live below a data root, which defaults to the Colab Drive folder
+and can be changed with the SKIN_CANCER_DATA_ROOT environment variable or the --data-root option of the cli.
+"""
+
+import os
+
+import numpy as np
+
+DATA_ROOT = os.environ.get("SKIN_CANCER_DATA_ROOT", "drive/My Drive/SkinCancer")
+
+def data_paths(data_root=DATA_ROOT):
+  """Returns the paths of the dataset files and training outputs below data_root"""
+  return {"metadata": os.path.join(data_root, "HAM10000_metadata.csv"),
+          "images": os.path.join(data_root, "train_data"),
+          "test_images": os.path.join(data_root, "test_data"),
+          "custom_images": os.path.join(data_root, "custom_data"),
+          "sample_zip": os.path.join(data_root, "sample_images.zip"),
+          "sample_images": os.path.join(data_root, "sample_images"),
+          "split": os.path.join(data_root, "split_index.npz"),
+          "store": os.path.join(data_root, "image_store"),
+          "logs": os.path.join(data_root, "logs"),
+          "checkpoints": os.path.join(data_root, "checkpoints"),
+          "embeddings": os.path.join(data_root, "embeddings"),
+          "models": os.path.join(data_root, "trained_models"),
+          "sweeps": os.path.join(data_root, "sweeps"),
+          "predictions": os.path.join(data_root, "test_predictions.csv"),
+          "custom_predictions": os.path.join(data_root, "custom_predictions.csv"),
+          "prediction_cache": os.path.join(data_root, "prediction_cache.sqlite")}
+
+PATHS = data_paths()
+
+# the diagnoses of the dx column of the metadata, the integer label of an image is its index
+CLASSES = np.array(["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"])
+
+CLASSNAMES = {'akiec': "Actinic keratoses",
+              'bcc': "basal cell carcinoma",
+              'bkl': "benign keratosis-like",
+              'df': "dermatofibroma",
+              'mel': "melanoma",
+              'nv': "melanocytic nevi",
+              'vasc': "vascular"}
+
+IMG_SIZE = 224
+BATCH_SIZE = 32
@@ -0,0 +1,178 @@
+"""
+Metadata, labels and the train, validation and test split.
+Several images can show the same lesion. The split keeps all images of a lesion in the same subset, so validation images never leak into training.
+Every class is split with the same fractions and the indices are cached, so reruns reuse the same split.
+The training data is balanced by copying filepaths once or while sampling the batches (see pipeline).
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from skin_cancer.config import CLASSES, PATHS
+
+SIZE = 10015
+VAL_SIZE = 0.15
+TEST_SIZE = 0.0
+NUM_FOLDS = 5
+SPLIT_PATH = PATHS["split"]
+
+# delete 40% of nv cases, increase mel and bkl cases by 50%, double bcc and akiec cases and triple vasc and df cases
+BALANCE_FACTORS = {"nv": 0.6, "mel": 1.5, "bkl": 1.5, "bcc": 2, "akiec": 2, "vasc": 3, "df": 3}
+# "copy" resamples the training data once, "weights" and "rejection" balance the classes while sampling batches
+BALANCING = "copy"
+
+def load_metadata(path=PATHS["metadata"]):
+  """Returns the HAM10000 metadata table"""
+  return pd.read_csv(path)
+
+def image_filepaths(metadata, img_dir=PATHS["images"]):
+  """Returns the jpg filepaths of the metadata rows"""
+  return [os.path.join(img_dir, fname + ".jpg") for fname in metadata["image_id"]]
+
+def metadata_labels(metadata):
+  """Returns the integer label of every metadata row, CLASSES[label] is its classname"""
+  return np.searchsorted(CLASSES, metadata["dx"].values).astype(np.int8)
+
+def split_columns(metadata):
+  """Returns integer encoded labels and lesion ids of the metadata"""
+  labels = np.searchsorted(CLASSES, metadata["dx"].values)
+  lesion_ids, _ = pd.factorize(metadata["lesion_id"])
+  return labels, lesion_ids
+
+def group_ranks(labels, groups, seed=42):
+  """Returns label, random rank within its class and class size of every group"""
+  group_ids, first = np.unique(groups, return_index=True)
+  group_labels = labels[first]
+  rng = np.random.default_rng(seed)
+  permutation = rng.permutation(len(group_ids))
+  order = permutation[np.argsort(group_labels[permutation], kind="stable")]
+  class_sizes = np.bincount(group_labels, minlength=len(CLASSES))
+  ranks = np.empty(len(group_ids), dtype=np.int64)
+  ranks[order] = np.arange(len(group_ids)) - np.repeat(np.cumsum(class_sizes) - class_sizes, class_sizes)
+  return group_labels, ranks, class_sizes[group_labels]
+
+def grouped_split(labels, groups, val_size=VAL_SIZE, test_size=TEST_SIZE, seed=42):
+  """
+  Returns shuffled train, validation and test index arrays of a lesion grouped and class stratified split.
+  Groups have to be integer ids from 0 to number of groups - 1.
+  """
+  group_labels, ranks, class_sizes = group_ranks(labels, groups, seed)
+  quantiles = (ranks + 0.5) / class_sizes
+  group_subsets = np.where(quantiles < test_size, 2, np.where(quantiles < test_size + val_size, 1, 0))
+  image_subsets = group_subsets[groups]
+  indices = np.random.default_rng(seed).permutation(len(labels))
+  return {name: indices[image_subsets[indices] == subset]
+          for subset, name in enumerate(["train", "val", "test"])}
+
+def grouped_kfold(labels, groups, k=NUM_FOLDS, seed=42):
+  """Returns k (train, validation) index array pairs of lesion grouped and class stratified folds"""
+  group_labels, ranks, class_sizes = group_ranks(labels, groups, seed)
+  image_folds = (ranks % k)[groups]
+  return [(np.flatnonzero(image_folds != fold), np.flatnonzero(image_folds == fold)) for fold in range(k)]
+
+def load_or_create_split(metadata, path=SPLIT_PATH, val_size=VAL_SIZE, test_size=TEST_SIZE, k=NUM_FOLDS, seed=42):
+  """
+  Returns train, val, test and k-fold index arrays of the metadata rows.
+  They are saved to path and reused as long as the metadata and split params do not change.
+  """
+  key = hashlib.sha256(metadata[["image_id", "lesion_id", "dx"]].to_csv(index=False).encode())
+  key.update(repr((val_size, test_size, k, seed)).encode())
+  key = key.hexdigest()
+  if os.path.exists(path):
+    cached = np.load(path)
+    if str(cached["key"]) == key:
+      print(f"Loaded split from {path}")
+      return {name: cached[name] for name in cached.files if name != "key"}
+
+  labels, lesion_ids = split_columns(metadata)
+  split = grouped_split(labels, lesion_ids, val_size, test_size, seed)
+  for fold, (train, val) in enumerate(grouped_kfold(labels, lesion_ids, k, seed)):
+    split[f"fold{fold}_train"] = train
+    split[f"fold{fold}_val"] = val
+  np.savez(path, key=key, **split)
+  print(f"Saved split to {path}")
+  return split
+
+def label_counts(labels):
+  """Returns number of labels of every class for an integer label array"""
+  return np.bincount(labels, minlength=len(CLASSES))
+
+def class_targets(labels, factors):
+  """Returns target counts per classname by scaling the current counts with factors"""
+  counts = label_counts(labels)
+  return {c: int(factors.get(c, 1) * count) for c, count in zip(CLASSES, counts)}
+
+def class_weights(labels, targets):
+  """
+  Returns the keras class_weight dict of the class ids of integer labels, which weights every class to its
+  target count of the targets dict of classnames. The weights average to 1 over the labels.
+  """
+  counts = label_counts(labels)
+  target_counts = np.array([targets.get(c, count) for c, count in zip(CLASSES, counts)], dtype=np.float64)
+  scale = counts.sum() / target_counts[counts > 0].sum()
+  return {int(class_id): target_counts[class_id] / counts[class_id] * scale for class_id in np.flatnonzero(counts)}
+
+def rebalance(labels, targets="undersample", size=None, seed=42):
+  """
+  Returns shuffled indices which resample an integer label array to a target count per class.
+  targets is "undersample" (count of the smallest class), "oversample" (count of the largest class)
+  or a dict of classnames to target counts (int) or fractions of size (float, size defaults to len(labels)).
+  Classes missing in the dict keep their count.
+  Classes are undersampled without replacement and oversampled with whole copies plus a random remainder.
+  """
+  labels = np.asarray(labels)
+  counts = label_counts(labels)
+  if targets == "undersample":
+    target_counts = np.where(counts > 0, counts[counts > 0].min(), 0)
+  elif targets == "oversample":
+    target_counts = np.where(counts > 0, counts.max(), 0)
+  else:
+    size = len(labels) if size is None else size
+    target_counts = counts.copy()
+    for class_name, target in targets.items():
+      class_id = np.searchsorted(CLASSES, class_name)
+      target_counts[class_id] = round(target * size) if isinstance(target, float) else target
+  if np.any((counts == 0) & (target_counts > 0)):
+    raise ValueError("Cannot resample classes without any labels")
+
+  rng = np.random.default_rng(seed)
+  # indices grouped by class and shuffled within each class
+  permutation = rng.permutation(len(labels))
+  order = permutation[np.argsort(labels[permutation], kind="stable")]
+  starts = np.cumsum(counts) - counts
+  # slot j of class c takes the (j mod count)th index of the shuffled class
+  slot_classes = np.repeat(np.arange(len(counts)), target_counts)
+  slots = np.arange(len(slot_classes)) - np.repeat(np.cumsum(target_counts) - target_counts, target_counts)
+  indices = order[starts[slot_classes] + slots % counts[slot_classes]]
+  rng.shuffle(indices)
+  return indices
+
+def prepare_data(metadata, img_dir=PATHS["images"], size=SIZE, split_path=SPLIT_PATH,
+                 balancing=BALANCING, balance_factors=BALANCE_FACTORS, test_size=TEST_SIZE):
+  """
+  Returns a dict of the train, validation and test filepaths (X_*) and integer labels (y_*) of size images
+  of the metadata, the class targets of the training data and the balancing.
+  With balancing "copy" the training data is resampled to the targets once,
+  "weights" and "rejection" keep it and balance the classes while sampling batches.
+  test_size is the fraction of every class held out as test data.
+  """
+  split = load_or_create_split(metadata, split_path, test_size=test_size)
+  X = np.array(image_filepaths(metadata, img_dir))
+  y = metadata_labels(metadata)
+
+  # use size images of the dataset
+  subset_fraction = size / len(metadata)
+  data = {"balancing": balancing}
+  for subset in ["train", "val", "test"]:
+    indices = split[subset][:int(len(split[subset]) * subset_fraction)]
+    data[f"X_{subset}"], data[f"y_{subset}"] = X[indices], y[indices]
+
+  data["balance_targets"] = class_targets(data["y_train"], balance_factors)
+  if balancing == "copy":
+    balanced_indices = rebalance(data["y_train"], data["balance_targets"])
+    data["X_train"] = data["X_train"][balanced_indices]
+    data["y_train"] = data["y_train"][balanced_indices]
+  return data
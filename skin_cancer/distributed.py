@@ -0,0 +1,106 @@
+"""
+Scaling benchmark of the distributed training.
+It starts local worker processes as stand-ins for nodes, each with its share of the cpu cores,
+and every worker trains the custom model with train_model under MultiWorkerMirroredStrategy,
+so the benchmark runs the real sharded, augmented and balanced training pipeline.
+The workers run in a temporary directory, their output is kept there and reported if a worker fails.
+"""
+
+import json
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+from skin_cancer.config import BATCH_SIZE
+
+# directory which contains the skin_cancer package, so the workers can import it
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_ports(n):
+  """Returns n free local ports"""
+  sockets = [socket.socket() for i in range(n)]
+  for s in sockets:
+    s.bind(("localhost", 0))
+  ports = [s.getsockname()[1] for s in sockets]
+  for s in sockets:
+    s.close()
+  return ports
+
+def scaling_worker(config_path):
+  """Trains the custom model with train_model as one worker of the cluster in TF_CONFIG and prints its images/sec"""
+  import tensorflow as tf
+
+  from skin_cancer.profiling import ProfilingCallback
+  from skin_cancer.training import train_model
+
+  with open(config_path, "rb") as config_file:
+    config = pickle.load(config_file)
+  tf.config.threading.set_intra_op_parallelism_threads(config["threads"])
+  strategy = tf.distribute.MultiWorkerMirroredStrategy()
+  profiler = ProfilingCallback()
+  train_model(config["training_data"], custom=True, strategy=strategy, checkpoint_dir="checkpoints",
+              epochs=config["epochs"], log_dir="logs", callbacks=[profiler])
+  if strategy.cluster_resolver.task_id == 0:
+    global_size = BATCH_SIZE * strategy.num_replicas_in_sync
+    print(json.dumps({"images_per_sec": profiler.summary()["steps_per_sec"] * global_size}))
+
+def run_local_workers(training_data, num_workers, epochs=1):
+  """
+  Trains the custom model on the prepare_data dict with num_workers local worker processes
+  and returns the training images/sec of the cluster, the first step of the training is not counted.
+  """
+  # the workers run in another directory, so relative filepaths are made absolute
+  training_data = dict(training_data, **{name: [os.path.abspath(filepath) for filepath in training_data[name]]
+                                         for name in ["X_train", "X_val"]})
+  with tempfile.TemporaryDirectory(prefix="scaling_") as work_dir:
+    config_path = os.path.join(work_dir, "config.pkl")
+    with open(config_path, "wb") as config_file:
+      pickle.dump({"training_data": training_data, "epochs": epochs,
+                   "threads": max(1, os.cpu_count() // num_workers)}, config_file)
+    cluster = {"worker": [f"localhost:{port}" for port in free_ports(num_workers)]}
+    workers, logs = [], []
+    for index in range(num_workers):
+      worker_dir = os.path.join(work_dir, f"worker{index}")
+      os.makedirs(worker_dir)
+      env = dict(os.environ,
+                 TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}}),
+                 PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get("PYTHONPATH")])),
+                 CUDA_VISIBLE_DEVICES="")
+      # the output goes to files, a full pipe of one worker would block the collectives of all workers
+      stdout, stderr = os.path.join(worker_dir, "stdout.log"), os.path.join(worker_dir, "stderr.log")
+      with open(stdout, "w") as stdout_file, open(stderr, "w") as stderr_file:
+        workers.append(subprocess.Popen([sys.executable, "-m", "skin_cancer.distributed", config_path],
+                                        cwd=worker_dir, env=env, stdout=stdout_file, stderr=stderr_file))
+      logs.append((stdout, stderr))
+    for worker in workers:
+      worker.wait()
+
+    failed = [index for index, worker in enumerate(workers) if worker.returncode]
+    if failed:
+      with open(logs[failed[0]][1]) as stderr_file:
+        errors = stderr_file.read()[-4000:]
+      raise RuntimeError(f"Worker {failed[0]} failed with exit code {workers[failed[0]].returncode}:\n{errors}")
+    with open(logs[0][0]) as stdout_file:
+      return json.loads(stdout_file.read().strip().splitlines()[-1])["images_per_sec"]
+
+def benchmark_scaling(training_data, num_workers=(1, 2, 4), epochs=1):
+  """Returns a table of the training images/sec and scaling efficiency for every number of local workers"""
+  results = []
+  for n in num_workers:
+    results.append({"workers": n,
+                    "global_batch_size": BATCH_SIZE * n,
+                    "images_per_sec": run_local_workers(training_data, n, epochs)})
+    print(results[-1])
+  report = pd.DataFrame(results)
+  # throughput relative to perfect linear scaling of the first configuration
+  per_worker = report["images_per_sec"][0] / report["workers"][0]
+  report["efficiency"] = report["images_per_sec"] / (report["workers"] * per_worker)
+  return report
+
+if __name__ == "__main__":
+  scaling_worker(sys.argv[1])
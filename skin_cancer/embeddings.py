@@ -0,0 +1,122 @@
+"""
+Frozen backbone training on cached embeddings.
+With a frozen hub model every epoch computes the same backbone outputs.
+They are computed once, cached in a memory mapped file per image id and only the dense head is trained on them.
+The cache key covers the model url, the backbone weights and the preprocessing, so a change of either creates a new cache.
+Training images are not augmented, since the cached outputs of an image never change.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.callbacks import LOG_DIR, PATIENCE, create_early_stopping, create_tensorboard_callback
+from skin_cancer.config import BATCH_SIZE, CLASSES, PATHS
+from skin_cancer.data import class_weights
+from skin_cancer.models import MODEL_URL, create_model
+from skin_cancer.pipeline import SPARSE_LABELS, create_batches
+from skin_cancer.preprocessing import preprocessing_version
+
+EMBEDDING_DIR = PATHS["embeddings"]
+HEAD_EPOCHS = 100
+# rows of the cached embeddings copied at a time when the cache grows
+COPY_ROWS = 4096
+
+def embedding_key(backbone, model_url=MODEL_URL):
+  """Returns the cache key of the backbone and the image preprocessing"""
+  key = hashlib.sha256(model_url.encode())
+  for weight in backbone.weights:
+    key.update(weight.numpy().tobytes())
+  key.update(preprocessing_version().encode())
+  return key.hexdigest()
+
+def filepath_ids(filepaths):
+  """Returns the image ids of image filepaths"""
+  return [os.path.splitext(os.path.basename(filepath))[0] for filepath in filepaths]
+
+def load_embeddings(cache_dir, key):
+  """Returns the cached image ids and memory mapped embeddings of key (empty if there is no cache)"""
+  index_path = os.path.join(cache_dir, f"{key}-ids.csv")
+  if not os.path.exists(index_path):
+    return pd.Index([]), None
+  ids = pd.Index(pd.read_csv(index_path)["image_id"])
+  return ids, np.load(os.path.join(cache_dir, f"{key}.npy"), mmap_mode="r")
+
+def append_embeddings(array_path, embeddings, new_batches, num_new):
+  """
+  Writes the cached embeddings (a memmap or None) followed by the num_new embeddings of new_batches
+  to a new npy file at array_path, one chunk or batch at a time, so neither has to fit in memory.
+  """
+  grown = None
+  position = 0 if embeddings is None else len(embeddings)
+  for batch in new_batches:
+    batch = np.asarray(batch, np.float32)
+    if grown is None:
+      grown = np.lib.format.open_memmap(array_path, mode="w+", dtype=np.float32,
+                                        shape=(position + num_new, *batch.shape[1:]))
+      for start in range(0, position, COPY_ROWS):
+        stop = min(start + COPY_ROWS, position)
+        grown[start:stop] = embeddings[start:stop]
+    grown[position:position + len(batch)] = batch
+    position += len(batch)
+  grown.flush()
+
+def cached_embeddings(filepaths, backbone, key, cache_dir=EMBEDDING_DIR, batch_size=BATCH_SIZE):
+  """
+  Returns the backbone outputs of the image filepaths, key is the embedding_key of the backbone.
+  Only images which are not in the cache of the backbone yet are run through it and added to the cache.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  ids, embeddings = load_embeddings(cache_dir, key)
+
+  filepaths = pd.Series(np.asarray(filepaths), index=filepath_ids(filepaths))
+  missing = filepaths[~filepaths.index.isin(ids)]
+  missing = missing[~missing.index.duplicated()]
+  if len(missing):
+    print(f"Computing {len(missing)} embeddings")
+    new_batches = (backbone.predict_on_batch(images) for images in create_batches(missing.values, size=batch_size))
+    # write to temporary files first, so an interrupted update keeps the old cache
+    array_path = os.path.join(cache_dir, f"{key}.npy")
+    append_embeddings(array_path + ".tmp.npy", embeddings, new_batches, len(missing))
+    pd.DataFrame({"image_id": ids.append(missing.index)}).to_csv(array_path + ".tmp.csv", index=False)
+    os.replace(array_path + ".tmp.npy", array_path)
+    os.replace(array_path + ".tmp.csv", os.path.join(cache_dir, f"{key}-ids.csv"))
+    ids, embeddings = load_embeddings(cache_dir, key)
+
+  return np.asarray(embeddings[ids.get_indexer(filepaths.index)])
+
+def train_head(training_data, model_url=MODEL_URL, epochs=HEAD_EPOCHS, batch_size=BATCH_SIZE, sparse=SPARSE_LABELS,
+               cache_dir=EMBEDDING_DIR, patience=PATIENCE, log_dir=LOG_DIR):
+  """
+  Trains the dense head of the frozen hub model on cached embeddings of the training and validation data
+  of the prepare_data dict. Returns the full model with the trained head.
+  """
+  model = create_model(model_url=model_url, sparse=sparse, trainable=False)
+  # the frozen hub layer of the model is the backbone, so the hub model is loaded and hashed once
+  backbone = tf.keras.Sequential(model.layers[:-1])
+  key = embedding_key(backbone, model_url)
+  y_train, y_val = training_data["y_train"], training_data["y_val"]
+  train_features = cached_embeddings(training_data["X_train"], backbone, key, cache_dir, batch_size)
+  val_features = cached_embeddings(training_data["X_val"], backbone, key, cache_dir, batch_size)
+  train_labels = y_train if sparse else np.eye(len(CLASSES), dtype=np.float32)[y_train]
+  val_labels = y_val if sparse else np.eye(len(CLASSES), dtype=np.float32)[y_val]
+
+  head = model.layers[-1]
+  head_model = tf.keras.Sequential([tf.keras.Input(train_features.shape[1:]), head])
+  head_model.compile(loss=model.loss, optimizer=tf.keras.optimizers.Adam(), metrics=["accuracy"])
+  # "copy" balancing already resampled X_train, the sampling balancings weight the classes to their targets instead
+  class_weight = None
+  if training_data["balancing"] != "copy":
+    class_weight = class_weights(y_train, training_data["balance_targets"])
+  head_model.fit(x=train_features,
+                 y=train_labels,
+                 batch_size=batch_size,
+                 class_weight=class_weight,
+                 epochs=epochs,
+                 validation_data=(val_features, val_labels),
+                 callbacks=[create_tensorboard_callback(log_dir=log_dir), create_early_stopping(patience)])
+  # the head layer is shared, so model already has the trained weights
+  return model
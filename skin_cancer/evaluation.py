@@ -0,0 +1,156 @@
+"""
+Evaluation of trained models.
+With test time augmentation every batch is expanded into k flipped and cropped views inside the graph and predicted in one forward pass.
+The probabilities of the views of each image are reduced to one prediction.
+compare_decode_modes compares the decode throughput and validation metrics of the decode modes before one of them is used.
+"""
+
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, CLASSES, IMG_SIZE
+from skin_cancer.metrics import MetricsAccumulator, compute_metrics
+from skin_cancer.pipeline import NUM_PARALLEL_CALLS, label_ids, parallel_map
+from skin_cancer.preprocessing import DECODE_MODES, preprocess_img
+
+TTA_VIEWS = 1
+TTA_REDUCTION = "mean"
+TTA_CROP = 0.875
+
+def tta_views(images, k=TTA_VIEWS, crop=TTA_CROP):
+  """
+  Returns k views of a batch of images stacked into one batch of k * batch size images.
+  The views are the original, flips and a center and four corner crops resized to IMG_SIZE.
+  """
+  views = [images,
+           tf.image.flip_left_right(images),
+           tf.image.flip_up_down(images),
+           tf.image.flip_up_down(tf.image.flip_left_right(images))]
+  offset = 1 - crop
+  boxes = [[offset / 2, offset / 2, 1 - offset / 2, 1 - offset / 2],
+           [0, 0, crop, crop], [0, offset, crop, 1], [offset, 0, 1, crop], [offset, offset, 1, 1]]
+  batch_size = tf.shape(images)[0]
+  for box in boxes:
+    views.append(tf.image.crop_and_resize(images,
+                                          tf.tile(tf.constant([box], tf.float32), [batch_size, 1]),
+                                          tf.range(batch_size),
+                                          [IMG_SIZE, IMG_SIZE]))
+  if not 1 <= k <= len(views):
+    raise ValueError(f"k has to be between 1 and {len(views)}")
+  return tf.concat(views[:k], axis=0)
+
+def tta_predict_fn(model, k=TTA_VIEWS, reduction=TTA_REDUCTION):
+  """Returns a function that predicts a batch of images from k views in one forward pass"""
+  if reduction not in ("mean", "max", "gmean"):
+    raise ValueError(f"Unknown reduction: {reduction}")
+
+  @tf.function
+  def predict(images):
+    batch_size = tf.shape(images)[0]
+    probabilities = tf.reshape(model(tta_views(images, k), training=False), [k, batch_size, -1])
+    if reduction == "mean":
+      return tf.reduce_mean(probabilities, axis=0)
+    if reduction == "max":
+      probabilities = tf.reduce_max(probabilities, axis=0)
+    else:
+      probabilities = tf.exp(tf.reduce_mean(tf.math.log(tf.maximum(probabilities, 1e-7)), axis=0))
+    return probabilities / tf.reduce_sum(probabilities, axis=1, keepdims=True)
+  return predict
+
+def make_batch_predict_fn(model, k=TTA_VIEWS, reduction=TTA_REDUCTION):
+  """Returns model.predict_on_batch or its test time augmented version for k > 1"""
+  if k > 1:
+    return tta_predict_fn(model, k, reduction)
+  return model.predict_on_batch
+
+THUMBNAIL_SIZE = 64
+
+def evaluate_model(model, data, keep=None, thumbnail_size=THUMBNAIL_SIZE, keep_probabilities=True,
+                   tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION):
+  """
+  Predicts every batch of data once and returns the probabilities and for labelled data
+  the integer labels and the metrics of the MetricsAccumulator.
+  keep="thumbnails" also returns the images downscaled to uint8 thumbnails for plotting,
+  keep="indices" only their positions in data.
+  keep_probabilities=False only accumulates the metrics, so memory does not grow with the data.
+  tta > 1 predicts tta augmented views of every image, reduced with tta_reduction.
+  """
+  predict_fn = make_batch_predict_fn(model, tta, tta_reduction)
+  probabilities = []
+  labels = []
+  thumbnails = []
+  accumulator = MetricsAccumulator()
+  num_images = 0
+  for batch in data:
+    images, batch_labels = batch if isinstance(batch, tuple) else (batch, None)
+    batch_probabilities = np.asarray(predict_fn(images))
+    num_images += len(batch_probabilities)
+    if keep_probabilities:
+      probabilities.append(batch_probabilities)
+    if batch_labels is not None:
+      batch_labels = label_ids(batch_labels.numpy())
+      accumulator.update(batch_probabilities, batch_labels)
+      if keep_probabilities:
+        labels.append(batch_labels)
+    if keep == "thumbnails":
+      thumbnails.append(tf.image.convert_image_dtype(tf.image.resize(images, [thumbnail_size, thumbnail_size]),
+                                                     tf.uint8, saturate=True).numpy())
+
+  results = {}
+  if keep_probabilities:
+    results["probabilities"] = np.concatenate(probabilities)
+  if accumulator.count:
+    results.update(accumulator.result())
+    if keep_probabilities:
+      results["labels"] = np.concatenate(labels)
+    print(f"loss: {results['loss']:.4f} - accuracy: {results['accuracy']:.4f} - "
+          f"balanced_accuracy: {results['balanced_accuracy']:.4f} - ece: {results['ece']:.4f}")
+  if keep == "thumbnails":
+    results["images"] = np.concatenate(thumbnails)
+  elif keep == "indices":
+    results["indices"] = np.arange(num_images)
+  return results
+
+def prediction_label(prediction, print=False):
+  """Prints label with highest probability for prediction array"""
+  max_index = prediction.argmax()
+  label = CLASSES[max_index]
+  if print:
+    print(f"Predicted label: {label} with {prediction[max_index]}")
+  
+  return label
+
+def compare_decode_modes(model, X, y, modes=DECODE_MODES, size=BATCH_SIZE,
+                         num_parallel_calls=NUM_PARALLEL_CALLS, epochs=2):
+  """
+  Returns a table of decoded images/sec, validation metrics and mean absolute pixel difference
+  to the full decode of the first batch for every decode mode.
+  """
+  y = np.asarray(y)
+  reference_batch = np.stack([preprocess_img(filepath, mode="full").numpy() for filepath in X[:size]])
+  results = []
+  for mode in modes:
+    data = tf.data.Dataset.from_tensor_slices(tf.constant(X))
+    data = parallel_map(data, functools.partial(preprocess_img, mode=mode), num_parallel_calls)
+    data = data.batch(size).prefetch(tf.data.AUTOTUNE)
+    start = time.perf_counter()
+    for epoch in range(epochs):
+      for images in data:
+        pass
+    images_per_sec = epochs * len(X) / (time.perf_counter() - start)
+    first_batch = next(iter(data)).numpy()
+    metrics = compute_metrics(model.predict(data, verbose=0), y)
+    results.append({"mode": mode,
+                    "images_per_sec": images_per_sec,
+                    "accuracy": metrics["accuracy"],
+                    "balanced_accuracy": metrics["balanced_accuracy"],
+                    "loss": metrics["loss"],
+                    "pixel_difference": np.abs(first_batch - reference_batch).mean()})
+
+  report = pd.DataFrame(results)
+  print(report)
+  return report
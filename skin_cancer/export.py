@@ -0,0 +1,98 @@
+"""
+Export of trained models to tflite and tfjs.
+Each quantized tflite export can be compared to the float keras model in size, cpu latency, validation accuracy and confusion matrix.
+tensorflowjs is only imported by export_tfjs.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, PATHS
+from skin_cancer.metrics import confusion
+from skin_cancer.preprocessing import preprocess_img
+from skin_cancer.tflite import TFLitePredictor, single_image_latency
+
+def export_tfjs(model, path=PATHS["models"]):
+  """Saves the model as tfjs layers model to the directory path"""
+  import tensorflowjs as tfjs
+  tfjs.converters.save_keras_model(model, path)
+  print(f"Saved tfjs model to: {path}")
+  return path
+
+NUM_CALIBRATION_IMAGES = 200
+
+def export_tflite(model, path="scc_model.tflite", quantization=None, calibration_images=None,
+                  num_calibration=NUM_CALIBRATION_IMAGES):
+  """
+  Converts the model to tflite and saves it to path.
+  quantization is None (float32), "dynamic" (int8 weights), "float16" (float16 weights)
+  or "int8" (int8 weights, activations, input and output calibrated on calibration_images filepaths).
+  """
+  # Convert the model.
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  if quantization is not None:
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if quantization == "float16":
+    converter.target_spec.supported_types = [tf.float16]
+  elif quantization == "int8":
+    def representative_dataset():
+      for img_filepath in calibration_images[:num_calibration]:
+        yield [preprocess_img(img_filepath)[tf.newaxis]]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+  elif quantization not in (None, "dynamic"):
+    raise ValueError(f"Unknown quantization: {quantization}")
+  tflite_model = converter.convert()
+
+  # Save the model.
+  with open(path, 'wb') as f:
+    f.write(tflite_model)
+  print(f"Saved {quantization or 'float32'} tflite model ({len(tflite_model) / 1e6:.1f} MB) to: {path}")
+  return path
+
+TARGET_ACCURACY = 0.8
+QUANTIZATIONS = [None, "dynamic", "float16", "int8"]
+
+def quantization_report(model, val_data, y_val, X_val, quantizations=QUANTIZATIONS,
+                        path_prefix="scc_model", num_latency=50):
+  """
+  Exports the model with every quantization and returns a table of model size, single image latency,
+  validation accuracy and confusion matrix change compared to the float keras model.
+  """
+  y_val = np.asarray(y_val)
+  images = np.concatenate([images for images, labels in
+                           val_data.take(int(np.ceil(num_latency / BATCH_SIZE))).as_numpy_iterator()])[:num_latency]
+  float_predictions = model.predict(val_data, verbose=0).argmax(axis=1)
+  float_cm = confusion(y_val, float_predictions)
+  float_accuracy = np.mean(float_predictions == y_val)
+  results = [{"model": "keras float32",
+              "size_mb": sum(w.size * w.dtype.itemsize for w in model.get_weights()) / 1e6,
+              "latency_ms": single_image_latency(model.predict_on_batch, images) * 1000,
+              "accuracy": float_accuracy,
+              "accuracy_delta": 0.0,
+              "cm_delta": np.zeros_like(float_cm)}]
+
+  for quantization in quantizations:
+    path = export_tflite(model, f"{path_prefix}_{quantization or 'float32'}.tflite", quantization, X_val)
+    with TFLitePredictor(path) as predictor:
+      predictions = predictor.predict(val_data).argmax(axis=1)
+    with TFLitePredictor(path, 1, batch_size=1) as predictor:
+      latency = single_image_latency(predictor.predict_on_batch, images)
+    cm = confusion(y_val, predictions)
+    accuracy = np.mean(predictions == y_val)
+    results.append({"model": path,
+                    "size_mb": os.path.getsize(path) / 1e6,
+                    "latency_ms": latency * 1000,
+                    "accuracy": accuracy,
+                    "accuracy_delta": accuracy - float_accuracy,
+                    "cm_delta": cm - float_cm})
+
+  report = pd.DataFrame(results)
+  report["meets_target"] = report["accuracy"] >= TARGET_ACCURACY
+  print(report.drop(columns="cm_delta"))
+  return report
@@ -0,0 +1,89 @@
+"""
+Import time benchmark of the package and the cli.
+Every entry point runs in a new interpreter with python -X importtime, which reports the cumulative import time
+of every module. The report shows the startup time of each entry point and the heavy dependencies in sys.modules
+after it ran (keras 3 itself imports matplotlib if it is installed).
+Run it with python -m skin_cancer.import_benchmark.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+HEAVY_MODULES = ["tensorflow", "tensorflow_hub", "tensorflowjs", "matplotlib", "seaborn"]
+MODULES_MARKER = "loaded modules:"
+
+def import_times(code):
+  """
+  Runs the python code in a new interpreter with -X importtime and returns the wall time in seconds,
+  the total import time in seconds and the names of the modules loaded at the end.
+  """
+  code += f"\nimport json, sys\nprint({MODULES_MARKER!r}, json.dumps(sorted(sys.modules)))"
+  start = time.perf_counter()
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+  wall_time = time.perf_counter() - start
+  if result.returncode:
+    raise RuntimeError(f"Benchmark failed with exit code {result.returncode}:\n{result.stderr[-2000:]}")
+
+  total = 0
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:"):
+      continue
+    self_us, cumulative_us, name = line[len("import time:"):].split("|")
+    # nested imports are indented by two spaces per level, top level imports sum up to the total
+    if cumulative_us.strip().isdigit() and len(name) - len(name.lstrip()) == 1:
+      total += int(cumulative_us) / 1e6
+  loaded = json.loads(result.stdout.split(MODULES_MARKER)[-1])
+  return wall_time, total, set(loaded)
+
+def create_predict_example(directory, num_images=4):
+  """Saves an untrained custom model and num_images random jpg images to directory, returns their paths"""
+  import numpy as np
+  import tensorflow as tf
+  from skin_cancer.config import IMG_SIZE
+  from skin_cancer.models import create_custom_model
+
+  model_path = os.path.join(directory, "custom_model.h5")
+  create_custom_model().save(model_path)
+  images_dir = os.path.join(directory, "images")
+  os.makedirs(images_dir)
+  rng = np.random.default_rng(0)
+  for i in range(num_images):
+    image = rng.integers(0, 256, size=(IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+    tf.io.write_file(os.path.join(images_dir, f"image_{i}.jpg"), tf.io.encode_jpeg(image))
+  return model_path, images_dir
+
+def benchmark_imports(model_path=None, images_dir=None, custom=True):
+  """
+  Returns a table of the wall time, import time and loaded heavy modules of importing the package,
+  the cli help, importing preprocess_img and predicting images_dir with the model at model_path.
+  Without model_path an untrained custom model and random images are predicted.
+  """
+  with tempfile.TemporaryDirectory() as directory:
+    if model_path is None:
+      model_path, images_dir = create_predict_example(directory)
+    predict_args = [model_path, images_dir, "--output", os.path.join(directory, "predictions.csv")]
+    predict_args += ["--custom"] if custom else []
+    entry_points = {"import skin_cancer": "import skin_cancer",
+                    "cli help": ("from skin_cancer.cli import main\n"
+                                 "try:\n  main(['--help'])\nexcept SystemExit:\n  pass"),
+                    "import preprocess_img": "from skin_cancer import preprocess_img",
+                    "predict": f"from skin_cancer.cli import main\nmain({['predict'] + predict_args!r})"}
+
+    results = []
+    for name, code in entry_points.items():
+      wall_time, import_time, modules = import_times(code)
+      results.append({"entry_point": name, "wall_sec": wall_time, "import_sec": import_time,
+                      **{module: module in modules for module in HEAVY_MODULES}})
+
+  report = pd.DataFrame(results)
+  print(report.to_string(index=False))
+  return report
+
+if __name__ == "__main__":
+  benchmark_imports()
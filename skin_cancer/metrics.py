@@ -0,0 +1,87 @@
+"""
+Classification metrics of the (N, 7) probability array and integer labels, computed with numpy.
+The accumulator updates them batch by batch, so the full prediction array is never needed.
+"""
+
+import numpy as np
+
+from skin_cancer.config import CLASSES
+
+NUM_CALIBRATION_BINS = 15
+TOP_K = 3
+
+def top_k(probabilities, k=TOP_K):
+  """Returns the class indices of the k highest probabilities of every row, highest first"""
+  top = np.argpartition(probabilities, -k, axis=1)[:, -k:]
+  order = np.argsort(-np.take_along_axis(probabilities, top, axis=1), axis=1)
+  return np.take_along_axis(top, order, axis=1)
+
+def confusion(labels, predicted_labels, num_classes=len(CLASSES)):
+  """Returns the confusion matrix (rows true, columns predicted labels) of integer labels"""
+  return np.bincount(np.asarray(labels, dtype=np.int64) * num_classes + predicted_labels,
+                     minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+def class_metrics(cm):
+  """Returns per class precision, recall and f1 and the balanced accuracy of a confusion matrix"""
+  true_positives = np.diag(cm).astype(np.float64)
+  predicted = cm.sum(axis=0)
+  actual = cm.sum(axis=1)
+  precision = np.divide(true_positives, predicted, out=np.zeros_like(true_positives), where=predicted > 0)
+  recall = np.divide(true_positives, actual, out=np.zeros_like(true_positives), where=actual > 0)
+  f1 = np.divide(2 * precision * recall, precision + recall,
+                 out=np.zeros_like(true_positives), where=(precision + recall) > 0)
+  balanced_accuracy = recall[actual > 0].mean() if np.any(actual > 0) else 0.0
+  return precision, recall, f1, balanced_accuracy
+
+class MetricsAccumulator:
+  """Accumulates confusion matrix, loss, top k hits and calibration bins over batches of probabilities and integer labels"""
+
+  def __init__(self, num_classes=len(CLASSES), k=TOP_K, num_bins=NUM_CALIBRATION_BINS):
+    self.num_classes = num_classes
+    self.k = k
+    self.num_bins = num_bins
+    self.cm = np.zeros((num_classes, num_classes), dtype=np.int64)
+    self.count = 0
+    self.loss_sum = 0.0
+    self.top_k_hits = 0
+    self.bin_counts = np.zeros(num_bins)
+    self.bin_confidences = np.zeros(num_bins)
+    self.bin_hits = np.zeros(num_bins)
+
+  def update(self, probabilities, labels):
+    """Adds a batch of probabilities and integer labels"""
+    probabilities = np.asarray(probabilities)
+    labels = np.asarray(labels, dtype=np.int64)
+    predicted = probabilities.argmax(axis=1)
+    confidences = probabilities.max(axis=1)
+    hits = predicted == labels
+    self.cm += confusion(labels, predicted, self.num_classes)
+    self.count += len(labels)
+    # categorical crossentropy of the softmax outputs, clipped like keras
+    self.loss_sum -= np.log(np.clip(probabilities[np.arange(len(labels)), labels], 1e-7, 1)).sum()
+    self.top_k_hits += np.any(top_k(probabilities, min(self.k, self.num_classes)) == labels[:, np.newaxis], axis=1).sum()
+    bins = np.minimum((confidences * self.num_bins).astype(np.int64), self.num_bins - 1)
+    self.bin_counts += np.bincount(bins, minlength=self.num_bins)
+    self.bin_confidences += np.bincount(bins, weights=confidences, minlength=self.num_bins)
+    self.bin_hits += np.bincount(bins, weights=hits, minlength=self.num_bins)
+
+  def result(self):
+    """Returns loss, accuracy, top k accuracy, balanced accuracy, per class precision, recall and f1,
+    expected calibration error and the confusion matrix"""
+    precision, recall, f1, balanced_accuracy = class_metrics(self.cm)
+    count = max(self.count, 1)
+    return {"loss": self.loss_sum / count,
+            "accuracy": np.trace(self.cm) / count,
+            f"top_{self.k}_accuracy": self.top_k_hits / count,
+            "balanced_accuracy": balanced_accuracy,
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "ece": np.abs(self.bin_hits - self.bin_confidences).sum() / count,
+            "confusion_matrix": self.cm.copy()}
+
+def compute_metrics(probabilities, labels, k=TOP_K, num_bins=NUM_CALIBRATION_BINS):
+  """Returns all metrics of a probability array and integer labels"""
+  accumulator = MetricsAccumulator(probabilities.shape[1], k, num_bins)
+  accumulator.update(probabilities, labels)
+  return accumulator.result()
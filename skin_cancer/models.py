@@ -0,0 +1,241 @@
+"""
+The transfer model on a TensorFlow Hub backbone and the custom convolutional model.
+With mixed_precision the layers of the custom model compute in bfloat16 and keep float32 weights, the softmax output
+layer stays float32. It is only used if the hardware has native bfloat16 support. The transfer model always runs in float32.
+jit_compile compiles the train and predict steps with XLA.
+tensorflow_hub is imported by the functions which need it, so the custom model loads without it.
+"""
+
+import contextlib
+import time
+
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, CLASSES, IMG_SIZE
+from skin_cancer.pipeline import SPARSE_LABELS
+
+MIXED_PRECISION = False
+JIT_COMPILE = False
+
+def bfloat16_supported():
+  """Returns True if a GPU is connected or the cpu has native bfloat16 instructions"""
+  if tf.config.list_physical_devices("GPU"):
+    return True
+  try:
+    with open("/proc/cpuinfo") as cpuinfo:
+      flags = cpuinfo.read()
+  except OSError:
+    return False
+  return "avx512_bf16" in flags or "amx_bf16" in flags
+
+@contextlib.contextmanager
+def precision_policy(mixed_precision=MIXED_PRECISION):
+  """Creates the layers inside the context with the mixed bfloat16 policy if mixed_precision is supported"""
+  previous_policy = tf.keras.mixed_precision.global_policy()
+  if mixed_precision and not bfloat16_supported():
+    print("bfloat16 is not supported, using float32")
+    mixed_precision = False
+  tf.keras.mixed_precision.set_global_policy("mixed_bfloat16" if mixed_precision else "float32")
+  try:
+    yield
+  finally:
+    tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+# use of pretrained model from TensorFlow Hun
+INPUT_SHAPE = [None, IMG_SIZE, IMG_SIZE, 3]
+OUTPUT_SHAPE = len(CLASSES)
+LEARNING_RATE = 0.001
+
+#MODEL_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_130_224/classification/4"
+MODEL_URL = "https://tfhub.dev/tensorflow/resnet_50/classification/1"
+
+def create_model(input_shape=INPUT_SHAPE, output_shape=OUTPUT_SHAPE, model_url=MODEL_URL, sparse=SPARSE_LABELS,
+                 trainable=True, mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE,
+                 learning_rate=LEARNING_RATE):
+  """
+  Creates, compiles and builds the model. Needs input shape, output shape and model url.
+  sparse=True compiles it for integer instead of one hot labels, trainable=False freezes the hub model.
+  mixed_precision has no effect: the hub model runs its saved float32 graph and only takes float32 inputs,
+  and the output layer stays float32. Only create_custom_model computes in bfloat16.
+  """
+  import tensorflow_hub as hub
+  print("Building model with:", model_url)
+
+  # setup model layers
+  with precision_policy(mixed_precision):
+    model = tf.keras.Sequential([
+      hub.KerasLayer(model_url, trainable=trainable, dtype="float32"), # input layer
+      tf.keras.layers.Dense(units=output_shape, activation="softmax", dtype="float32") # output layer
+      ])
+  
+  # compile model
+  model.compile(
+      loss=tf.keras.losses.SparseCategoricalCrossentropy() if sparse else tf.keras.losses.CategoricalCrossentropy(),
+      optimizer=tf.keras.optimizers.Adam(learning_rate),
+      metrics=["accuracy"],
+      jit_compile=jit_compile
+      )
+  
+  # build model
+  model.build(input_shape)
+  
+  return model
+
+INPUT_SHAPE2 = (IMG_SIZE, IMG_SIZE, 3)
+
+def create_custom_model(input_shape=INPUT_SHAPE2, output_shape=OUTPUT_SHAPE, sparse=SPARSE_LABELS,
+                        mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE,
+                        learning_rate=LEARNING_RATE, **layer_params):
+    """
+    Returns a compiled convolutional neural network model. 
+    sparse=True compiles it for integer instead of one hot labels.
+    layer_params are the filters, dense_units and dropout of custom_model_layers.
+    """
+    with precision_policy(mixed_precision):
+      model = custom_model_layers(input_shape, output_shape, **layer_params)
+
+    # compile model
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy() if sparse else tf.keras.losses.CategoricalCrossentropy(),
+        metrics=["accuracy"],
+        jit_compile=jit_compile
+    )
+
+    return model
+
+def custom_model_layers(input_shape=INPUT_SHAPE2, output_shape=OUTPUT_SHAPE,
+                        filters=(32, 32, 64), dense_units=128, dropout=0.5):
+    """
+    Returns the uncompiled layers of the custom model.
+    filters are the widths of the convolutions, each but the last one is followed by max pooling.
+    """
+    layers = [
+        # convolution layer on input (images)
+        tf.keras.layers.Conv2D(
+            filters[0], (3, 3), activation="relu", input_shape=input_shape
+        )
+    ]
+    for width in filters[1:]:
+        layers += [
+            # max - pooling layer, 2x2 pool
+            tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
+
+            # new convolution
+            tf.keras.layers.Conv2D(
+                width, (3, 3), activation="relu")
+        ]
+
+    return tf.keras.models.Sequential(layers + [
+        # pooling of the last convolution
+        tf.keras.layers.GlobalAveragePooling2D(),
+
+        # flatten units
+        tf.keras.layers.Flatten(),
+
+        # hidden layer with dropout
+        tf.keras.layers.Dense(dense_units, activation="relu"),
+
+        # dropout layer 
+        tf.keras.layers.Dropout(dropout),
+
+        # output layer
+        tf.keras.layers.Dense(output_shape, activation="softmax", dtype="float32")
+    ])
+
+def custom_model_params(model):
+    """Returns the filters, dense_units and dropout of a custom model"""
+    layers = model.layers
+    return {"filters": tuple(layer.filters for layer in layers if isinstance(layer, tf.keras.layers.Conv2D)),
+            "dense_units": [layer.units for layer in layers if isinstance(layer, tf.keras.layers.Dense)][0],
+            "dropout": [layer.rate for layer in layers if isinstance(layer, tf.keras.layers.Dropout)][0]}
+
+# on cpu the process keeps memory of earlier configs, for exact peak memory benchmark one config per runtime
+PRECISION_CONFIGS = {
+    "float32": dict(mixed_precision=False, jit_compile=False),
+    "float32 + xla": dict(mixed_precision=False, jit_compile=True),
+    "mixed bfloat16": dict(mixed_precision=True, jit_compile=False),
+    "mixed bfloat16 + xla": dict(mixed_precision=True, jit_compile=True),
+}
+
+def host_memory_mb(field="VmRSS"):
+  """Returns the resident (VmRSS) or peak resident (VmHWM) memory of the process (linux)"""
+  with open("/proc/self/status") as status:
+    for line in status:
+      if line.startswith(field):
+        return int(line.split()[1]) / 1e3
+
+def peak_memory_mb(reset=False):
+  """Returns the peak memory of the gpu or the peak resident memory of the process (linux) since the last reset"""
+  if tf.config.list_physical_devices("GPU"):
+    if reset:
+      tf.config.experimental.reset_memory_stats("GPU:0")
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 1e6
+  if reset:
+    # resets the peak resident set size of the process
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+      clear_refs.write("5")
+  return host_memory_mb("VmHWM")
+
+def benchmark_precision(configs=PRECISION_CONFIGS, steps=50, size=BATCH_SIZE, warmup=3):
+  """Returns a table of train and predict steps/sec and peak memory of the custom model for every config"""
+  images = tf.random.uniform([size, IMG_SIZE, IMG_SIZE, 3])
+  labels = tf.one_hot(tf.random.uniform([size], maxval=OUTPUT_SHAPE, dtype=tf.int32), OUTPUT_SHAPE)
+  results = []
+  for name, config in configs.items():
+    tf.keras.backend.clear_session()
+    model = create_custom_model(**config)
+    peak_memory_mb(reset=True)
+    for step in range(warmup):
+      model.train_on_batch(images, labels)
+      model.predict_on_batch(images)
+
+    start = time.perf_counter()
+    for step in range(steps):
+      model.train_on_batch(images, labels)
+    train_steps_per_sec = steps / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for step in range(steps):
+      model.predict_on_batch(images)
+    predict_steps_per_sec = steps / (time.perf_counter() - start)
+
+    results.append({"config": name,
+                    "train_steps_per_sec": train_steps_per_sec,
+                    "predict_steps_per_sec": predict_steps_per_sec,
+                    "peak_memory_mb": peak_memory_mb()})
+
+  report = pd.DataFrame(results)
+  print(report)
+  return report
+
+def load_model(filepath, custom=False, mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE):
+  """Loads a trained model, with mixed_precision or jit_compile it is rebuilt and recompiled accordingly"""
+  if custom:
+    model = tf.keras.models.load_model(filepath)
+  else:
+    import tensorflow_hub as hub
+    model = tf.keras.models.load_model(filepath, custom_objects={"KerasLayer":hub.KerasLayer})
+  if mixed_precision or jit_compile:
+    model = with_precision(model, custom, mixed_precision, jit_compile)
+  return model
+
+def with_precision(model, custom=False, mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE):
+  """Returns a copy of the trained model with the precision policy, compiled with jit_compile"""
+  with precision_policy(mixed_precision):
+    if custom:
+      precision_model = custom_model_layers(model.input_shape[1:], model.output_shape[-1], **custom_model_params(model))
+    else:
+      import tensorflow_hub as hub
+      precision_model = tf.keras.Sequential([
+        hub.KerasLayer(model.layers[0].handle, trainable=model.layers[0].trainable, dtype="float32"),
+        tf.keras.layers.Dense(units=model.output_shape[-1], activation="softmax", dtype="float32")
+        ])
+      precision_model.build(model.input_shape)
+  precision_model.set_weights(model.get_weights())
+  precision_model.compile(loss=model.loss,
+                          optimizer=tf.keras.optimizers.Adam(),
+                          metrics=["accuracy"],
+                          jit_compile=jit_compile)
+  return precision_model
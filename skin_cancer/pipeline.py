@@ -0,0 +1,356 @@
+"""
+Batching of the images and labels with tf.data.
+Batching is necessary since not all images fit into memory within one batch.
+The preprocessed image store keeps the resized images as uint8 arrays in memory mapped numpy shards,
+so decoding and resizing the full resolution images, the most expensive step of every epoch, has to be done only once.
+Instead of copying filepaths, the classes can be balanced while sampling the training batches.
+Every sampled image gets a new random transformation and memory does not grow with the number of copies.
+"""
+
+import functools
+import os
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, CLASSES, IMG_SIZE, PATHS
+from skin_cancer.data import label_counts
+from skin_cancer.preprocessing import (AUGMENT, AUGMENT_SEED, augment_labelled_batch, augment_params,
+                                       preprocess_img, preprocessed_img_label_pair, preprocessing_version)
+
+# input pipeline settings
+NUM_PARALLEL_CALLS = tf.data.AUTOTUNE # number of decode workers, tf.data.AUTOTUNE or None (serial)
+PREFETCH = True
+CACHE = None # None, "memory" or a filepath for an on-disk cache of the decoded validation images
+DETERMINISTIC = True
+
+def parallel_map(data, func, num_parallel_calls=NUM_PARALLEL_CALLS, deterministic=DETERMINISTIC):
+  """Maps func over data with num_parallel_calls workers (serial if None)"""
+  if num_parallel_calls is None:
+    return data.map(func)
+  return data.map(func, num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+
+STORE_PATH = PATHS["store"]
+SHARD_SIZE = 2048
+STORE_VERSION_FILE = "preprocessing_version.txt"
+
+def resized_img_uint8(img_filepath):
+  """Returns the decoded and resized image as uint8 tensor"""
+  image = preprocess_img(img_filepath)
+  return tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+
+def build_store(metadata, img_dir, store_path=STORE_PATH, shard_size=SHARD_SIZE):
+  """
+  Writes the decoded and resized images of all metadata rows into memory mapped shards.
+  The preprocessing version is written next to the index csv, which maps every image_id to its label,
+  shard and row and is written last.
+  """
+  os.makedirs(store_path, exist_ok=True)
+  num_images = len(metadata)
+  positions = np.arange(num_images)
+  index = pd.DataFrame({"image_id": metadata["image_id"].values,
+                        "dx": metadata["dx"].values,
+                        "label": np.searchsorted(CLASSES, metadata["dx"].values),
+                        "shard": positions // shard_size,
+                        "row": positions % shard_size})
+
+  shards = []
+  for shard in range(int(np.ceil(num_images / shard_size))):
+    rows = min(shard_size, num_images - shard * shard_size)
+    shards.append(np.lib.format.open_memmap(os.path.join(store_path, f"images-{shard:05d}.npy"),
+                                            mode="w+",
+                                            dtype=np.uint8,
+                                            shape=(rows, IMG_SIZE, IMG_SIZE, 3)))
+
+  filepaths = [os.path.join(img_dir, image_id + ".jpg") for image_id in index["image_id"]]
+  data = tf.data.Dataset.from_tensor_slices(tf.constant(filepaths))
+  data = parallel_map(data, resized_img_uint8).batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+  position = 0
+  for images in data.as_numpy_iterator():
+    while len(images):
+      shard, row = divmod(position, shard_size)
+      count = min(len(images), shard_size - row)
+      shards[shard][row:row + count] = images[:count]
+      images = images[count:]
+      position += count
+
+  for shard in shards:
+    shard.flush()
+  with open(os.path.join(store_path, STORE_VERSION_FILE), "w") as version_file:
+    version_file.write(preprocessing_version())
+  index.to_csv(os.path.join(store_path, "index.csv"), index=False)
+  print(f"Stored {num_images} images in {len(shards)} shards at {store_path}")
+  return index
+
+def load_store(store_path=STORE_PATH):
+  """
+  Opens the shards of a built store read only and returns them with the index.
+  Raises a ValueError if the images were stored with another preprocessing than the current one.
+  """
+  version = None
+  version_path = os.path.join(store_path, STORE_VERSION_FILE)
+  if os.path.exists(version_path):
+    with open(version_path) as version_file:
+      version = version_file.read().strip()
+  if version != preprocessing_version():
+    raise ValueError(f"The store at {store_path} was built with another preprocessing, rebuild it with build_store")
+  index = pd.read_csv(os.path.join(store_path, "index.csv")).set_index("image_id")
+  shards = [np.load(os.path.join(store_path, f"images-{shard:05d}.npy"), mmap_mode="r")
+            for shard in range(index["shard"].max() + 1)]
+  return {"index": index, "shards": shards}
+
+def store_positions(store, img_filepaths):
+  """Returns (shard, row) pairs of image filepaths in the store"""
+  image_ids = [os.path.splitext(os.path.basename(path))[0] for path in img_filepaths]
+  return store["index"].loc[image_ids, ["shard", "row"]].values
+
+def store_reader(store):
+  """Returns a function that reads the image at a (shard, row) position of the store as tensor"""
+  def read_array(position):
+    shard, row = position
+    return store["shards"][shard][row]
+
+  def read_img(position):
+    image = tf.numpy_function(read_array, [position], tf.uint8)
+    image.set_shape([IMG_SIZE, IMG_SIZE, 3])
+    return tf.image.convert_image_dtype(image, tf.float32)
+  return read_img
+
+# integer labels are one hot encoded in the batches, True keeps them for a sparse categorical loss
+SPARSE_LABELS = False
+
+def encode_labels(images, labels, sparse=SPARSE_LABELS):
+  """Casts a batch of integer labels to int32 or one hot encodes it"""
+  labels = tf.cast(labels, tf.int32)
+  if not sparse:
+    labels = tf.one_hot(labels, len(CLASSES))
+  return images, labels
+
+def label_ids(labels):
+  """Returns integer labels of a batch of integer or one hot labels"""
+  labels = np.asarray(labels)
+  return labels.argmax(axis=-1) if labels.ndim > 1 else labels
+
+def shard_data(X, y, shard):
+  """Returns every num_shards-th element of X and y starting at index for shard=(num_shards, index)"""
+  num_shards, index = shard
+  return np.asarray(X)[index::num_shards], (None if y is None else np.asarray(y)[index::num_shards])
+
+def steps_per_epoch(num_images, size=BATCH_SIZE):
+  """Returns the number of training batches of an epoch"""
+  return int(np.ceil(num_images / size))
+
+def create_batches(X, y=None, valid_data=False, size=BATCH_SIZE,
+                   num_parallel_calls=NUM_PARALLEL_CALLS, prefetch=PREFETCH,
+                   cache=CACHE, deterministic=DETERMINISTIC, store=None,
+                   sparse=SPARSE_LABELS, augment=AUGMENT, initial_epoch=0, shard=None):
+  """
+  Creates batches of X and integer label y pairs. Shuffels train data.
+  Labels are one hot encoded per batch unless sparse is True.
+  Training data repeats endlessly from initial_epoch on (train with steps_per_epoch), every epoch is
+  shuffled with its own seed and its batches are augmented unless augment is False.
+  Images are decoded by num_parallel_calls workers, prefetch overlaps preprocessing
+  with training and cache keeps the decoded validation images in memory or on disk.
+  deterministic=False lets the workers return images out of order.
+  With a store from load_store the resized images are read from its shards instead of the jpeg files.
+  shard=(num_shards, index) keeps every num_shards-th image starting at index, one shard per worker.
+  """
+  if shard is not None:
+    X, y = shard_data(X, y, shard)
+  if store is None:
+    load_img = preprocess_img
+    load_pair = preprocessed_img_label_pair
+  else:
+    X = store_positions(store, X)
+    load_img = store_reader(store)
+    def load_pair(position, label):
+      return load_img(position), label
+
+  if y is None:   # no labels
+    print("Created test data batches")
+    data = tf.data.Dataset.from_tensor_slices((tf.constant(X)))
+    data_batch = parallel_map(data, load_img,
+                              num_parallel_calls, deterministic).batch(size)
+    if prefetch:
+      data_batch = data_batch.prefetch(tf.data.AUTOTUNE)
+    return data_batch
+
+  elif valid_data:
+    print("Created validation data batches")
+    data = tf.data.Dataset.from_tensor_slices((tf.constant(X),
+                                               tf.constant(y)))
+    data = parallel_map(data, load_pair,
+                        num_parallel_calls, deterministic)
+    if cache == "memory":
+      data = data.cache()
+    elif cache:
+      data = data.cache(cache)
+    data_batch = data.batch(size)
+
+  else:
+    print("Created training data batches")
+    num_images = len(X)
+    data= tf.data.Dataset.from_tensor_slices((tf.constant(X),
+                                              tf.constant(y),
+                                              tf.range(num_images, dtype=tf.int64)))
+
+    def epoch_batches(epoch):
+      def load_example(image, label, index):
+        seed = tf.stack([AUGMENT_SEED + epoch, epoch * num_images + index])
+        return load_img(image), label, augment_params(seed)
+
+      epoch_data = data.shuffle(buffer_size=num_images, seed=AUGMENT_SEED + epoch)
+      epoch_data = parallel_map(epoch_data, load_example,
+                                num_parallel_calls, deterministic).batch(size)
+      return epoch_data.map(functools.partial(augment_labelled_batch, augment=augment))
+
+    data_batch = tf.data.Dataset.counter(initial_epoch).flat_map(epoch_batches)
+
+  data_batch = data_batch.map(functools.partial(encode_labels, sparse=sparse))
+  if prefetch:
+    data_batch = data_batch.prefetch(tf.data.AUTOTUNE)
+
+  return data_batch
+
+def create_sampled_batches(X, y, target_dist=None, method="weights", epoch_size=None,
+                           size=BATCH_SIZE, num_parallel_calls=NUM_PARALLEL_CALLS,
+                           prefetch=PREFETCH, deterministic=DETERMINISTIC, store=None,
+                           sparse=SPARSE_LABELS, augment=AUGMENT, initial_epoch=0, shard=None):
+  """
+  Creates training batches which sample X and integer label y pairs with the target class distribution.
+  target_dist maps classnames to relative weights (default uniform over the present classes).
+  method "weights" samples from one repeated dataset per class,
+  "rejection" rejects elements of the shuffled dataset until the distribution matches.
+  An epoch has epoch_size images (default len(X)). Like the training data of create_batches the
+  batches repeat endlessly from initial_epoch on and every epoch samples with its own seed.
+  With shard=(num_shards, index) each shard samples epoch_size / num_shards images of its part of X.
+  """
+  print("Created class balanced training data batches")
+  X = np.asarray(X)
+  y = np.asarray(y)
+  epoch_size = len(X) if epoch_size is None else epoch_size
+  if shard is not None:
+    X, y = shard_data(X, y, shard)
+    epoch_size = int(np.ceil(epoch_size / shard[0]))
+  counts = label_counts(y)
+
+  if target_dist is None:
+    target_dist = {c: 1 for c, count in zip(CLASSES, counts) if count > 0}
+  weights = np.array([target_dist.get(c, 0) for c in CLASSES], dtype=np.float64)
+  weights /= weights.sum()
+  if np.any((counts == 0) & (weights > 0)):
+    raise ValueError("Cannot sample classes without any labels")
+
+  if store is None:
+    load_img = preprocess_img
+  else:
+    X = store_positions(store, X)
+    load_img = store_reader(store)
+
+  if method == "weights":
+    class_ids = np.flatnonzero(weights)
+    class_datasets = [tf.data.Dataset.from_tensor_slices((tf.constant(X[y == class_id]),
+                                                          tf.constant(y[y == class_id])))
+                      for class_id in class_ids]
+
+    def sample_epoch(epoch):
+      seed = AUGMENT_SEED + epoch * len(CLASSES)
+      return tf.data.Dataset.sample_from_datasets(
+          [class_data.shuffle(buffer_size=counts[class_id], seed=seed + class_id).repeat()
+           for class_id, class_data in zip(class_ids, class_datasets)],
+          weights=weights[class_ids].tolist(),
+          seed=seed)
+
+  elif method == "rejection":
+    def class_func(image, label):
+      return tf.cast(label, tf.int32)
+
+    def drop_class(class_id, element):
+      return element
+
+    data = tf.data.Dataset.from_tensor_slices((tf.constant(X),
+                                               tf.constant(y)))
+
+    def sample_epoch(epoch):
+      seed = AUGMENT_SEED + epoch
+      epoch_data = data.shuffle(buffer_size=len(X), seed=seed).repeat()
+      epoch_data = epoch_data.rejection_resample(class_func,
+                                                 target_dist=weights.astype(np.float32),
+                                                 initial_dist=(counts / counts.sum()).astype(np.float32),
+                                                 seed=AUGMENT_SEED)
+      return epoch_data.map(drop_class)
+
+  else:
+    raise ValueError(f"Unknown sampling method: {method}")
+
+  def epoch_batches(epoch):
+    def load_example(index, element):
+      image, label = element
+      seed = tf.stack([AUGMENT_SEED + epoch, epoch * epoch_size + index])
+      return load_img(image), label, augment_params(seed)
+
+    epoch_data = sample_epoch(epoch).take(epoch_size).enumerate()
+    epoch_data = parallel_map(epoch_data, load_example, num_parallel_calls, deterministic).batch(size)
+    return epoch_data.map(functools.partial(augment_labelled_batch, augment=augment))
+
+  data_batch = tf.data.Dataset.counter(initial_epoch).flat_map(epoch_batches)
+  data_batch = data_batch.map(functools.partial(encode_labels, sparse=sparse))
+  if prefetch:
+    data_batch = data_batch.prefetch(tf.data.AUTOTUNE)
+
+  return data_batch
+
+def training_size(training_data):
+  """Returns the number of training images of an epoch of the prepare_data dict"""
+  if training_data["balancing"] == "copy":
+    return len(training_data["X_train"])
+  return sum(training_data["balance_targets"].values())
+
+def create_train_data(training_data, size=BATCH_SIZE, shard=None, initial_epoch=0, store=None):
+  """Returns the training batches of X_train and y_train of the prepare_data dict balanced with its balancing"""
+  if training_data["balancing"] == "copy":
+    return create_batches(training_data["X_train"], training_data["y_train"], size=size, shard=shard,
+                          initial_epoch=initial_epoch, store=store)
+  return create_sampled_batches(training_data["X_train"], training_data["y_train"],
+                                target_dist=training_data["balance_targets"],
+                                method=training_data["balancing"],
+                                epoch_size=training_size(training_data),
+                                size=size,
+                                shard=shard,
+                                initial_epoch=initial_epoch,
+                                store=store)
+
+PIPELINE_CONFIGS = {
+    "serial": dict(num_parallel_calls=None, prefetch=False),
+    "parallel": dict(num_parallel_calls=tf.data.AUTOTUNE, prefetch=False),
+    "parallel 4 workers": dict(num_parallel_calls=4, prefetch=False),
+    "parallel + prefetch": dict(num_parallel_calls=tf.data.AUTOTUNE, prefetch=True),
+    "parallel + prefetch + memory cache": dict(num_parallel_calls=tf.data.AUTOTUNE, prefetch=True, cache="memory"),
+    "parallel + prefetch, non-deterministic": dict(num_parallel_calls=tf.data.AUTOTUNE, prefetch=True, deterministic=False),
+}
+
+def load_sample_images(metadata, zip_path=PATHS["sample_zip"], extract_dir=PATHS["sample_images"]):
+  """Unzips the sample images and returns their filepaths and labels from the metadata"""
+  with zipfile.ZipFile(zip_path) as archive:
+    archive.extractall(extract_dir)
+    fnames = sorted(archive.namelist())
+  sample_ids = [os.path.splitext(fname)[0] for fname in fnames]
+  sample_filepaths = [os.path.join(extract_dir, fname) for fname in fnames]
+  sample_labels = np.searchsorted(CLASSES, metadata.set_index("image_id").loc[sample_ids, "dx"].values)
+  return sample_filepaths, sample_labels
+
+def benchmark_pipeline(X, y, configs=PIPELINE_CONFIGS, epochs=3):
+  """Prints images/sec of the validation pipeline for each configuration"""
+  results = {}
+  for name, config in configs.items():
+    data = create_batches(X, y, valid_data=True, **config)
+    start = time.perf_counter()
+    for epoch in range(epochs):
+      for images, labels in data:
+        pass
+    results[name] = epochs * len(X) / (time.perf_counter() - start)
+    print(f"{name}: {results[name]:.1f} images/sec")
+  return results
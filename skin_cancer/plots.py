@@ -0,0 +1,114 @@
+"""
+Plots of the data, the images and the predictions with matplotlib.
+"""
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from skin_cancer.config import CLASSES, CLASSNAMES
+from skin_cancer.data import label_counts
+from skin_cancer.evaluation import prediction_label
+from skin_cancer.metrics import top_k
+from skin_cancer.pipeline import label_ids
+
+def show_img(images, labels, num=20):
+  """Displays 20 images and their label from a batch"""
+  plt.figure(figsize=(10,10))
+
+  # subplots of images with their labels
+  for i in range(num):
+    ax = plt.subplot(5, 5, i+1)
+    plt.imshow(images[i])
+    plt.title(CLASSNAMES[CLASSES[label_ids(labels)[i]]])
+    plt.axis("off")
+
+def data_distribution(y, classes=CLASSES):
+  """creates plot of data distribution"""
+  counts = label_counts(y)
+  df = pd.DataFrame(data={'class': classes, 'count': counts}).sort_values(by=['count'])
+  df.plot.barh(x='class', 
+               y='count',
+               figsize=(10,6),
+               title="Data Distribution",
+               color=["salmon"]);
+  return None
+
+def plot_prediction(predictions_probs, true_labels, images, n=1):
+  """View the prediction """
+  pred_prob, true_label, image = predictions_probs[n], true_labels[n], images[n]
+
+  pred_label = prediction_label(pred_prob)
+
+  plt.imshow(image)
+  plt.xticks([])
+  plt.yticks([])
+
+  if pred_label == true_label:
+    color = "green"
+  else:
+    color = "red"
+
+  plt.title("Pred: {} {:2.0f}%, True: {}".format(CLASSNAMES[pred_label],
+                                    np.max(pred_prob)*100,
+                                    true_label),
+                                    color = color)
+
+def top_preds(prediction_probs, labels, n=1):
+  """top 10 highest preds"""
+  pred_prob, true_label = prediction_probs[n], labels[n]
+
+  pred_label = prediction_label(pred_prob)
+  top_indexes = top_k(pred_prob[np.newaxis], min(10, len(pred_prob)))[0]
+  top_preds = pred_prob[top_indexes]
+  top_labels = CLASSES[top_indexes]
+
+  top_plot = plt.bar(np.arange(len(top_labels)),
+                               top_preds,
+                               color = "grey")
+  plt.xticks(np.arange(len(top_labels)),
+             labels=top_labels,
+             rotation ="vertical")
+  if np.isin(true_label, top_labels):
+    top_plot[np.argmax(top_labels == true_label)].set_color("green")
+
+def plot_predicion_distributions(predicions, true_labels, images, i_start=0):
+  """Plots multiple image, prediction distribution pairs. Starts Data at i_start"""
+  rows = 3
+  cols = 2
+  num_img = rows*cols
+  plt.figure(figsize=(10*cols, 5*rows))
+  for i in range(num_img):
+    plt.subplot(rows, 2*cols, 2*i+1)
+    plot_prediction(predicions, true_labels, images, n=i+i_start)
+    plt.subplot(rows, 2*cols, 2*i+2)
+    top_preds(predicions, true_labels, i+i_start)
+  plt.tight_layout()
+  plt.show()
+
+def plot_test_predictions(predicted_labels, predictions, images):
+  """Plots images and their predicted labels"""
+  i_start = 90
+  rows = 3
+  cols = 10
+  num_img = rows*cols
+  plt.figure(figsize=(2*cols, 2.5*rows))
+  for i in range(num_img):
+    plt.subplot(rows, cols, i+1)
+    plt.xticks([])
+    plt.yticks([])
+    plt.title("{} {:2.0f}%".format(predicted_labels[i],
+                                  np.max(predictions[i])*100))
+    plt.imshow(images[i])
+  plt.show()
+
+def plot_confusion_matrix(cm, title="Validation Data Confusion Matrix"):
+  """Plots the confusion matrix of integer labels as annotated heatmap"""
+  import seaborn as sn
+  df_cm = pd.DataFrame(cm, index = CLASSES, columns = CLASSES)
+  plt.figure(figsize=(10,7))
+  sn.heatmap(df_cm, annot=True,  fmt="d")
+  plt.title(title)
+  plt.ylabel("True label")
+  plt.xlabel("Predicted label")
+  plt.show()
@@ -0,0 +1,87 @@
+"""
+Predictions of unlabelled images written to a csv, batch by batch.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from skin_cancer.config import CLASSES
+from skin_cancer.evaluation import TTA_REDUCTION, TTA_VIEWS, make_batch_predict_fn
+from skin_cancer.pipeline import create_batches
+from skin_cancer.prediction_cache import cached_predict_batches
+
+PREDICT_BATCH_SIZE = 64
+
+def list_images(images):
+  """Returns the sorted jpg filepaths of a directory or the given list of filepaths"""
+  if isinstance(images, str):
+    return sorted(os.path.join(images, fname) for fname in os.listdir(images)
+                  if fname.lower().endswith((".jpg", ".jpeg")))
+  return list(images)
+
+def image_ids(filepaths):
+  """Returns the image ids (filenames without extension) of filepaths"""
+  return [os.path.splitext(os.path.basename(path))[0] for path in filepaths]
+
+def predicted_ids(output_csv):
+  """Returns the IMG_IDs already written to a prediction csv and drops a partially written last row"""
+  if not os.path.exists(output_csv):
+    return set()
+  with open(output_csv, "rb+") as f:
+    content = f.read()
+    if content and not content.endswith(b"\n"):
+      f.truncate(content.rfind(b"\n") + 1)
+  if os.path.getsize(output_csv) == 0:
+    return set()
+  return set(pd.read_csv(output_csv, usecols=["IMG_ID"])["IMG_ID"].astype(str))
+
+def predict_batches(model, filepaths, batch_size=PREDICT_BATCH_SIZE, tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION):
+  """Yields the positions in filepaths and the predictions of every batch"""
+  predict_fn = make_batch_predict_fn(model, tta, tta_reduction)
+  start = 0
+  for images in create_batches(filepaths, size=batch_size):
+    predictions = np.asarray(predict_fn(images))
+    yield range(start, start + len(predictions)), predictions
+    start += len(predictions)
+
+def predict_directory(model, images, output_csv, batch_size=PREDICT_BATCH_SIZE, resume=True,
+                      tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION, cache=None):
+  """
+  Predicts images (a directory or list of filepaths) in batches of batch_size and appends
+  an IMG_ID and class probabilities row per image to output_csv after every batch.
+  With resume=True images already in output_csv are skipped, otherwise the csv is overwritten.
+  tta > 1 predicts tta augmented views of every image, reduced with tta_reduction.
+  With a PredictionCache the cached images are written first and only the others are decoded and predicted.
+  Returns the number of predicted images.
+  """
+  filepaths = list_images(images)
+  if not resume and os.path.exists(output_csv):
+    os.remove(output_csv)
+  done = predicted_ids(output_csv)
+  todo = [(path, img_id) for path, img_id in zip(filepaths, image_ids(filepaths)) if img_id not in done]
+  print(f"Predicting {len(todo)} of {len(filepaths)} images")
+  if not todo:
+    return 0
+
+  filepaths = [path for path, img_id in todo]
+  if cache is None:
+    batches = predict_batches(model, filepaths, batch_size, tta, tta_reduction)
+  else:
+    batches = cached_predict_batches(model, filepaths, cache, batch_size, tta, tta_reduction)
+  # a resumed csv may have its header without rows, the header is only written to an empty file
+  write_header = not os.path.exists(output_csv) or os.path.getsize(output_csv) == 0
+  with open(output_csv, "a", newline="") as f:
+    for positions, predictions in batches:
+      rows = pd.DataFrame(predictions, columns=CLASSES)
+      rows.insert(0, "IMG_ID", [todo[position][1] for position in positions])
+      rows.to_csv(f, header=write_header, index=False)
+      f.flush()
+      write_header = False
+  print(f"Saved predictions to {output_csv}")
+  if cache is not None:
+    report = cache.report()
+    print(f"Prediction cache: {report['hits']} hits, {report['misses']} misses (hit rate {report['hit_rate']:.1%}), "
+          f"{report['entries']} entries, {report['size_mb']:.1f} MB")
+  return len(todo)
@@ -0,0 +1,165 @@
+"""
+Content addressed cache of predictions.
+An image is looked up by the sha256 of its jpeg bytes together with the model and the preprocessing version,
+so copied or renamed images hit the cache and a retrained model or changed decoding never returns stale predictions.
+Hits skip decoding and the forward pass, only the misses go through create_batches and the model.
+The predictions are kept in a sqlite file, which drops the least recently used entries when it grows over its size limit.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from skin_cancer.config import BATCH_SIZE, PATHS
+from skin_cancer.evaluation import TTA_REDUCTION, TTA_VIEWS, make_batch_predict_fn
+from skin_cancer.pipeline import create_batches
+from skin_cancer.preprocessing import preprocessing_version
+
+CACHE_PATH = PATHS["prediction_cache"]
+MAX_CACHE_MB = 256
+# eviction frees some room below the limit, so not every insert of a full cache evicts
+EVICT_TO = 0.9
+# keys per sqlite query, below the limit of query variables of older sqlite versions
+QUERY_SIZE = 500
+
+def model_identity(model):
+  """Returns a hash of the model file of a tflite or SavedModel predictor, or of the weights of a keras model"""
+  key = hashlib.sha256()
+  path = getattr(model, "model_path", None)
+  if path is None:
+    for weight in model.weights:
+      key.update(repr(tuple(weight.shape)).encode())
+      key.update(np.asarray(weight.numpy()).tobytes())
+    return key.hexdigest()
+
+  if os.path.isdir(path):
+    filepaths = sorted(os.path.join(root, fname) for root, dirs, fnames in os.walk(path) for fname in fnames)
+  else:
+    filepaths = [path]
+  for filepath in filepaths:
+    key.update(os.path.relpath(filepath, path).encode())
+    with open(filepath, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 20), b""):
+        key.update(chunk)
+  return key.hexdigest()
+
+def cache_namespace(model, tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION):
+  """Returns the part of the cache keys which identifies the model, the preprocessing and the test time augmentation"""
+  key = hashlib.sha256(model_identity(model).encode())
+  key.update(preprocessing_version().encode())
+  key.update(repr((tta, tta_reduction if tta > 1 else None)).encode())
+  return key.hexdigest()
+
+def image_keys(filepaths, namespace):
+  """Returns the cache keys of the jpeg files in namespace"""
+  keys = []
+  for filepath in filepaths:
+    key = hashlib.sha256(namespace.encode())
+    with open(filepath, "rb") as f:
+      key.update(f.read())
+    keys.append(key.hexdigest())
+  return keys
+
+class PredictionCache:
+  """On-disk key value store of predictions with least recently used eviction above max_mb of keys and predictions"""
+
+  def __init__(self, path=CACHE_PATH, max_mb=MAX_CACHE_MB):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    self.path = path
+    self.max_mb = max_mb
+    self.connection = sqlite3.connect(path)
+    with self.connection:
+      self.connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                              "(key TEXT PRIMARY KEY, prediction BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+      self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_accessed ON predictions (accessed)")
+    self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+    self.hits = self.misses = self.evictions = 0
+
+  def select(self, column, keys):
+    """Yields the key and column of the cached entries of keys"""
+    for start in range(0, len(keys), QUERY_SIZE):
+      query = keys[start:start + QUERY_SIZE]
+      yield from self.connection.execute(
+          f"SELECT key, {column} FROM predictions WHERE key IN ({','.join('?' * len(query))})", query)
+
+  def get(self, keys):
+    """Returns a dict of the cached predictions of keys and marks them as recently used"""
+    found = {key: np.frombuffer(prediction, np.float32) for key, prediction in self.select("prediction", keys)}
+    with self.connection:
+      self.connection.executemany("UPDATE predictions SET accessed = ? WHERE key = ?",
+                                  [(time.time(), key) for key in found])
+    self.hits += sum(key in found for key in keys)
+    self.misses += sum(key not in found for key in keys)
+    return found
+
+  def put(self, keys, predictions):
+    """Stores the predictions of keys and evicts the least recently used entries above max_mb"""
+    rows = []
+    for key, prediction in zip(keys, np.asarray(predictions, np.float32)):
+      prediction = prediction.tobytes()
+      rows.append((key, prediction, len(key) + len(prediction), time.time()))
+    replaced = sum(size for key, size in self.select("size", list(keys)))
+    with self.connection:
+      self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)", rows)
+    self.size += sum(row[2] for row in rows) - replaced
+    if self.size > self.max_mb * 1e6:
+      self.evict()
+
+  def evict(self):
+    """Drops the least recently used entries until the cache is below EVICT_TO of max_mb"""
+    excess = self.size - EVICT_TO * self.max_mb * 1e6
+    evicted = []
+    for key, size in self.connection.execute("SELECT key, size FROM predictions ORDER BY accessed"):
+      if excess <= 0:
+        break
+      evicted.append((key,))
+      excess -= size
+      self.size -= size
+    with self.connection:
+      self.connection.executemany("DELETE FROM predictions WHERE key = ?", evicted)
+    self.evictions += len(evicted)
+
+  def report(self):
+    """Returns the hits, misses, hit rate and evictions since opening and the entries and size of the cache"""
+    lookups = self.hits + self.misses
+    entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+    return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions, "entries": entries, "size_mb": self.size / 1e6}
+
+  def close(self):
+    self.connection.close()
+
+def cached_predict_batches(model, filepaths, cache, batch_size=BATCH_SIZE, tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION):
+  """
+  Yields (positions, predictions) of the images at filepaths: first the cached predictions in chunks of batch_size,
+  then the predictions of the missing images batch by batch, which are added to the cache.
+  """
+  keys = image_keys(filepaths, cache_namespace(model, tta, tta_reduction))
+  cached = cache.get(keys)
+  hits = [position for position, key in enumerate(keys) if key in cached]
+  for start in range(0, len(hits), batch_size):
+    positions = hits[start:start + batch_size]
+    yield positions, np.stack([cached[keys[position]] for position in positions])
+
+  misses = [position for position, key in enumerate(keys) if key not in cached]
+  if not misses:
+    return
+  predict_fn = make_batch_predict_fn(model, tta, tta_reduction)
+  start = 0
+  for images in create_batches([filepaths[position] for position in misses], size=batch_size):
+    predictions = np.asarray(predict_fn(images))
+    positions = misses[start:start + len(predictions)]
+    cache.put([keys[position] for position in positions], predictions)
+    yield positions, predictions
+    start += len(predictions)
+
+def cached_predict(model, filepaths, cache, batch_size=BATCH_SIZE, tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION):
+  """Returns the predictions of the images at filepaths in their order, only cache misses are decoded and predicted"""
+  predictions = [None] * len(filepaths)
+  for positions, batch_predictions in cached_predict_batches(model, filepaths, cache, batch_size, tta, tta_reduction):
+    for position, prediction in zip(positions, batch_predictions):
+      predictions[position] = prediction
+  return np.stack(predictions)
@@ -0,0 +1,141 @@
+"""
+Decoding, resizing and augmentation of the jpeg images.
+Training batches are augmented after decoding and resizing, with one op per batch for every step.
+The random numbers of every image come from a stateless seed of the epoch and its index, so augmentations differ between images and epochs and are reproducible across runs.
+"""
+
+import functools
+import hashlib
+import inspect
+
+import numpy as np
+import tensorflow as tf
+
+from skin_cancer.config import IMG_SIZE
+
+# the HAM10000 images are 600x450, more than twice the model input size.
+# "ratio" lets the jpeg decoder downscale in the DCT domain by the largest factor that keeps both sides at least IMG_SIZE,
+# "crop" additionally decodes only the central square, so the image is not squeezed by the resize
+
+DECODE_MODE = "full"
+DECODE_MODES = ["full", "ratio", "crop"]
+DECODE_RATIOS = [1, 2, 4, 8]
+
+def preprocess_img(img_filepath, transform=False, mode=DECODE_MODE):
+  """Takes image and turns it into tensor"""
+  # read img file
+  image = tf.io.read_file(img_filepath)
+  return decode_img(image, transform, mode)
+
+def decode_ratio_index(shape, size=IMG_SIZE):
+  """Returns the index in DECODE_RATIOS of the largest ratio which keeps the shorter side at least size"""
+  shorter_side = tf.minimum(shape[0], shape[1])
+  return tf.reduce_sum(tf.cast(shorter_side // DECODE_RATIOS[1:] >= size, tf.int32))
+
+def decode_central_square(image, shape, ratio):
+  """Decodes only the central square of jpeg bytes, downscaled by ratio"""
+  # the crop window is given in the coordinates of the downscaled image
+  height, width = -(-shape[0] // ratio), -(-shape[1] // ratio)
+  side = tf.minimum(height, width)
+  window = tf.stack([(height - side) // 2, (width - side) // 2, side, side])
+  return tf.io.decode_and_crop_jpeg(image, window, channels=3, ratio=ratio)
+
+def decode_jpeg_scaled(image, mode=DECODE_MODE):
+  """Decodes jpeg bytes near IMG_SIZE with the decoder ratio (and the central square for mode "crop")"""
+  shape = tf.io.extract_jpeg_shape(image)
+  if mode == "crop":
+    decoders = [functools.partial(decode_central_square, image, shape, ratio)
+                for ratio in DECODE_RATIOS]
+  else:
+    decoders = [functools.partial(tf.io.decode_jpeg, image, channels=3, ratio=ratio)
+                for ratio in DECODE_RATIOS]
+  return tf.switch_case(decode_ratio_index(shape), decoders)
+
+def decode_img(image, transform=False, mode=DECODE_MODE):
+  """Takes jpeg bytes and turns them into tensor"""
+  # turn img into tensor
+  if mode == "full":
+    image = tf.image.decode_jpeg(image, channels=3)
+  elif mode in ("ratio", "crop"):
+    image = decode_jpeg_scaled(image, mode)
+  else:
+    raise ValueError(f"Unknown decode mode: {mode}")
+  # convert colour channel
+  image = tf.image.convert_image_dtype(image, tf.float32)
+  # resize image
+  image = tf.image.resize(image, size=[IMG_SIZE, IMG_SIZE])
+  # transform image
+  if transform:
+    seed = tf.random.uniform([2], maxval=tf.int64.max, dtype=tf.int64)
+    image = augment_batch(image[tf.newaxis], augment_params(seed)[tf.newaxis])[0]
+
+  return image
+
+def preprocessing_version(mode=DECODE_MODE):
+  """Returns a hash of the decoding code and settings, it changes whenever the preprocessed images change"""
+  key = hashlib.sha256()
+  for func in (preprocess_img, decode_img, decode_jpeg_scaled, decode_central_square):
+    key.update(inspect.getsource(func).encode())
+  key.update(repr((mode, IMG_SIZE)).encode())
+  return key.hexdigest()
+
+def preprocessed_img_label_pair(img_filepath, label, transform=False):
+  """Retruns tuple of preprocesed image and its label"""
+  image = preprocess_img(img_filepath, transform)
+  return image, label
+
+AUGMENT = True
+AUGMENT_SEED = 42
+NUM_AUGMENT_PARAMS = 8
+MAX_ROTATION = 30 # degrees
+MIN_CROP = 0.8 # smallest crop side relative to the image side
+MAX_BRIGHTNESS = 0.1
+MAX_CONTRAST = 0.2
+
+def augment_params(seed):
+  """Returns the uniform random numbers of one image for a stateless seed of shape [2]"""
+  return tf.random.stateless_uniform([NUM_AUGMENT_PARAMS], seed=seed)
+
+def augment_batch(images, params):
+  """
+  Randomly flips, rotates, crops and changes brightness and contrast of a batch of images.
+  params holds NUM_AUGMENT_PARAMS uniform random numbers per image.
+  """
+  # flip left right and up down
+  images = tf.where(params[:, 0, None, None, None] < 0.5, tf.reverse(images, axis=[2]), images)
+  images = tf.where(params[:, 1, None, None, None] < 0.5, tf.reverse(images, axis=[1]), images)
+
+  # rotate around the image center
+  angles = (params[:, 2] * 2 - 1) * MAX_ROTATION * np.pi / 180
+  cos, sin = tf.cos(angles), tf.sin(angles)
+  side = float(IMG_SIZE - 1)
+  x_offsets = (side - (cos * side - sin * side)) / 2
+  y_offsets = (side - (sin * side + cos * side)) / 2
+  zeros = tf.zeros_like(angles)
+  transforms = tf.stack([cos, -sin, x_offsets, sin, cos, y_offsets, zeros, zeros], axis=1)
+  images = tf.raw_ops.ImageProjectiveTransformV3(images=images,
+                                                 transforms=transforms,
+                                                 output_shape=[IMG_SIZE, IMG_SIZE],
+                                                 fill_value=0.0,
+                                                 interpolation="BILINEAR",
+                                                 fill_mode="REFLECT")
+
+  # crop a random square and resize it back
+  scales = MIN_CROP + params[:, 3] * (1 - MIN_CROP)
+  tops = params[:, 4] * (1 - scales)
+  lefts = params[:, 5] * (1 - scales)
+  boxes = tf.stack([tops, lefts, tops + scales, lefts + scales], axis=1)
+  images = tf.image.crop_and_resize(images, boxes, tf.range(tf.shape(images)[0]), [IMG_SIZE, IMG_SIZE])
+
+  # brightness and contrast
+  brightness = (params[:, 6] * 2 - 1) * MAX_BRIGHTNESS
+  contrast = 1 + (params[:, 7] * 2 - 1) * MAX_CONTRAST
+  means = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+  images = (images - means) * contrast[:, None, None, None] + means + brightness[:, None, None, None]
+  return tf.clip_by_value(images, 0.0, 1.0)
+
+def augment_labelled_batch(images, labels, params, augment=AUGMENT):
+  """Returns the augmented batch of images (unchanged if augment is False) and its labels"""
+  if augment:
+    images = augment_batch(images, params)
+  return images, labels
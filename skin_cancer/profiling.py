@@ -0,0 +1,157 @@
+"""
+Profiling of the training.
+With profile=True train_model records the time of every step, the host memory of every epoch and the batches/sec of the
+training data on its own, traces the steps PROFILE_STEPS with the TensorFlow profiler (tensorboard profile tab)
+and writes a json summary next to its tensorboard logs.
+A run is input bound if the training data cannot deliver batches as fast as the model trains on them.
+profile_training splits single training steps into the wait for the next batch and the compute of the step,
+and measures the throughput of the pipeline stages.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from skin_cancer.callbacks import LOG_DIR, create_tensorboard_callback
+from skin_cancer.config import BATCH_SIZE
+from skin_cancer.models import MODEL_URL, create_custom_model, create_model, host_memory_mb
+from skin_cancer.pipeline import NUM_PARALLEL_CALLS, create_train_data, parallel_map
+from skin_cancer.preprocessing import AUGMENT_SEED, NUM_AUGMENT_PARAMS, augment_batch, decode_img
+
+PROFILE = False
+PROFILE_STEPS = (10, 20)
+PROFILE_SUMMARY_FILE = "profile_summary.json"
+INPUT_BOUND_FRACTION = 0.1 # share of the step time spent waiting for input
+
+class ProfilingCallback(tf.keras.callbacks.Callback):
+  """Records the duration of every training step and epoch and the host memory after every epoch"""
+  def __init__(self):
+    super().__init__()
+    self.step_times = []
+    self.epochs = []
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.epoch_start = time.perf_counter()
+
+  def on_train_batch_begin(self, batch, logs=None):
+    self.step_start = time.perf_counter()
+
+  def on_train_batch_end(self, batch, logs=None):
+    self.step_times.append(time.perf_counter() - self.step_start)
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.epochs.append({"epoch": epoch,
+                        "seconds": time.perf_counter() - self.epoch_start,
+                        "rss_mb": host_memory_mb()})
+
+  def summary(self):
+    """Returns the step time statistics and the epochs"""
+    # the first step includes tracing the train function
+    step_times = np.array(self.step_times[1:] or self.step_times) * 1000
+    return {"steps": len(self.step_times),
+            "step_ms": {"mean": step_times.mean(),
+                        "p50": np.percentile(step_times, 50),
+                        "p90": np.percentile(step_times, 90),
+                        "max": step_times.max()},
+            "steps_per_sec": 1000 / step_times.mean(),
+            "epochs": self.epochs,
+            "peak_rss_mb": host_memory_mb("VmHWM")}
+
+def data_throughput(data, num_batches=20, warmup=2):
+  """Returns the batches/sec of iterating data on its own"""
+  iterator = iter(data)
+  for batch in range(warmup):
+    next(iterator)
+  start = time.perf_counter()
+  for batch in range(num_batches):
+    next(iterator)
+  return num_batches / (time.perf_counter() - start)
+
+def pipeline_stage_throughput(X, y, num_images=256, size=BATCH_SIZE,
+                              num_parallel_calls=NUM_PARALLEL_CALLS):
+  """
+  Returns the images/sec of the training pipeline up to and including each stage
+  (read files, decode and resize, batch, augment) on the first num_images of X.
+  """
+  X = np.asarray(X)[:num_images]
+  y = np.asarray(y)[:num_images]
+  files = tf.data.Dataset.from_tensor_slices((tf.constant(X), tf.constant(y)))
+
+  def read(img_filepath, label):
+    return tf.io.read_file(img_filepath), label
+
+  def decode(image, label):
+    return decode_img(image), label
+
+  def augment(images, labels):
+    params = tf.random.stateless_uniform([tf.shape(images)[0], NUM_AUGMENT_PARAMS], seed=[AUGMENT_SEED, 0])
+    return augment_batch(images, params), labels
+
+  stages = {}
+  stages["read"] = parallel_map(files, read, num_parallel_calls)
+  stages["decode"] = parallel_map(stages["read"], decode, num_parallel_calls)
+  stages["batch"] = stages["decode"].batch(size)
+  stages["augment"] = stages["batch"].map(augment)
+
+  throughput = {}
+  for name, data in stages.items():
+    start = time.perf_counter()
+    for element in data:
+      pass
+    throughput[name] = len(X) / (time.perf_counter() - start)
+  return throughput
+
+def profile_steps(model, data, num_steps=50, trace_steps=PROFILE_STEPS, logdir=None):
+  """
+  Trains the model on num_steps batches of data one by one and returns the mean time spent waiting for the
+  next batch and computing the step. With a logdir the steps trace_steps are traced with the TensorFlow profiler.
+  """
+  iterator = iter(data)
+  input_wait, compute = [], []
+  for step in range(num_steps):
+    if logdir and step == trace_steps[0]:
+      tf.profiler.experimental.start(logdir)
+    with tf.profiler.experimental.Trace("train", step_num=step, _r=1):
+      start = time.perf_counter()
+      images, labels = next(iterator)
+      fetched = time.perf_counter()
+      model.train_on_batch(images, labels)
+      input_wait.append(fetched - start)
+      compute.append(time.perf_counter() - fetched)
+    if logdir and step == trace_steps[1] - 1:
+      tf.profiler.experimental.stop()
+  # the first step includes tracing the train function
+  input_wait_ms = np.mean(input_wait[1:]) * 1000
+  compute_ms = np.mean(compute[1:]) * 1000
+  return {"input_wait_ms": input_wait_ms,
+          "compute_ms": compute_ms,
+          "input_fraction": input_wait_ms / (input_wait_ms + compute_ms)}
+
+def write_profile_summary(summary, logdir):
+  """Writes the summary as json next to the tensorboard logs and returns its path"""
+  os.makedirs(logdir, exist_ok=True)
+  path = os.path.join(logdir, PROFILE_SUMMARY_FILE)
+  with open(path, "w") as summary_file:
+    json.dump(summary, summary_file, indent=2, default=float)
+  print(f"Profile summary saved to: {path}")
+  return path
+
+def profile_training(training_data, custom=False, num_steps=50, trace_steps=PROFILE_STEPS, log_dir=LOG_DIR):
+  """
+  Profiles num_steps training steps of a new model on the training data of the prepare_data dict: input wait and
+  compute per step, throughput of the pipeline stages and host memory. Returns the summary, which is also written as json.
+  """
+  model = create_custom_model() if custom else create_model()
+  logdir = create_tensorboard_callback(log_dir=log_dir).log_dir
+  summary = {"model": "custom" if custom else MODEL_URL,
+             "batch_size": BATCH_SIZE,
+             "steps": profile_steps(model, create_train_data(training_data), num_steps, trace_steps, logdir),
+             "pipeline_images_per_sec": pipeline_stage_throughput(training_data["X_train"], training_data["y_train"]),
+             "rss_mb": host_memory_mb(),
+             "peak_rss_mb": host_memory_mb("VmHWM")}
+  summary["input_bound"] = bool(summary["steps"]["input_fraction"] > INPUT_BOUND_FRACTION)
+  write_profile_summary(summary, logdir)
+  return summary
@@ -0,0 +1,173 @@
+"""
+Registry of loaded models.
+Models are loaded by path from any of the formats .h5 (or .keras), SavedModel, TFLite and tfjs and kept in an LRU cache,
+keyed by path and format. When the estimated memory of the cached models exceeds the budget, the least recently used are dropped.
+After loading, every model predicts zero images at the warm-up batch sizes, so tracing the predict function
+(and allocating the interpreter tensors) is done before the first request.
+The memory of a model is estimated by the size of its files.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, IMG_SIZE
+from skin_cancer.models import load_model
+from skin_cancer.tflite import TFLitePredictor
+from skin_cancer.tfjs_model import load_tfjs_model, model_json_path, read_model_json
+
+# formats of model files by extension, SavedModels and tfjs models can also be directories
+MODEL_FORMATS = {".h5": "h5", ".keras": "keras", ".tflite": "tflite", ".json": "tfjs"}
+MEMORY_BUDGET_MB = 2048
+# single images and full batches, the last partial batch reuses the trace of the full batch
+WARMUP_BATCH_SIZES = (1, BATCH_SIZE)
+
+def detect_format(path):
+  """Returns the format of the model file or directory at path"""
+  if os.path.isdir(path):
+    if os.path.exists(os.path.join(path, "saved_model.pb")):
+      return "savedmodel"
+    if os.path.exists(os.path.join(path, "model.json")):
+      return "tfjs"
+  extension = os.path.splitext(path)[1].lower()
+  if extension not in MODEL_FORMATS:
+    raise ValueError(f"Unknown model format: {path}")
+  return MODEL_FORMATS[extension]
+
+def model_files_mb(path, model_format):
+  """Returns the size of the files of a model, a tfjs model.json includes its weight shards"""
+  if model_format == "tfjs":
+    json_path = model_json_path(path)
+    shard_paths = [os.path.join(os.path.dirname(json_path), shard_path)
+                   for group in read_model_json(path)["weightsManifest"] for shard_path in group["paths"]]
+    return sum(os.path.getsize(filepath) for filepath in [json_path] + shard_paths) / 1e6
+  if not os.path.isdir(path):
+    return os.path.getsize(path) / 1e6
+  return sum(os.path.getsize(os.path.join(root, fname))
+             for root, dirs, fnames in os.walk(path) for fname in fnames) / 1e6
+
+class SavedModelPredictor:
+  """Predicts images with the serving signature of a SavedModel and the predict interface of a keras model"""
+
+  def __init__(self, path, signature="serving_default"):
+    self.model_path = path
+    self.model = tf.saved_model.load(path)
+    self.signature = self.model.signatures[signature]
+    self.input_name = next(iter(self.signature.structured_input_signature[1]))
+
+  def __call__(self, images, training=False):
+    outputs = self.signature(**{self.input_name: tf.convert_to_tensor(images, tf.float32)})
+    return next(iter(outputs.values()))
+
+  def predict_on_batch(self, images):
+    return self(images).numpy()
+
+  def predict(self, data, verbose=0):
+    """Returns the predictions of an image array or the batches of create_batches"""
+    if isinstance(data, np.ndarray):
+      return self.predict_on_batch(data)
+    return np.concatenate([self.predict_on_batch(batch[0] if isinstance(batch, tuple) else batch)
+                           for batch in data])
+
+def load_model_file(path, model_format=None, custom=False, batch_size=BATCH_SIZE):
+  """
+  Loads the model at path in model_format (default by its extension).
+  Keras models are loaded with load_model, tflite models as TFLitePredictor with batch_size
+  SavedModels as SavedModelPredictor and tfjs layers-models with load_tfjs_model, all predict batches with predict_on_batch.
+  """
+  model_format = model_format or detect_format(path)
+  if model_format in ("h5", "keras"):
+    return load_model(path, custom=custom)
+  if model_format == "savedmodel":
+    return SavedModelPredictor(path)
+  if model_format == "tflite":
+    return TFLitePredictor(path, batch_size=batch_size)
+  if model_format == "tfjs":
+    return load_tfjs_model(path)
+  raise ValueError(f"Unknown model format: {model_format}")
+
+def warm_up(model, batch_sizes=WARMUP_BATCH_SIZES):
+  """Predicts zero images at every batch size (at most the batch size of a tflite model) and returns the seconds it took"""
+  start = time.perf_counter()
+  for size in batch_sizes:
+    size = min(size, getattr(model, "batch_size", size))
+    model.predict_on_batch(np.zeros([size, IMG_SIZE, IMG_SIZE, 3], np.float32))
+  return time.perf_counter() - start
+
+def close_model(model):
+  """Releases the threads and interpreters of a model which has a close method, e.g. a TFLitePredictor"""
+  if hasattr(model, "close"):
+    model.close()
+
+class ModelRegistry:
+  """
+  LRU cache of loaded and warmed up models within a memory budget, keyed by model path and format.
+  Evicted models are closed, get the model again instead of keeping it.
+  """
+
+  def __init__(self, memory_budget_mb=MEMORY_BUDGET_MB, warmup_batch_sizes=WARMUP_BATCH_SIZES, batch_size=BATCH_SIZE):
+    self.memory_budget_mb = memory_budget_mb
+    self.warmup_batch_sizes = warmup_batch_sizes
+    self.batch_size = batch_size
+    self.models = collections.OrderedDict()
+    self.stats = {}
+    # one model is loaded at a time, so concurrent requests for the same model load it once
+    self.lock = threading.Lock()
+
+  def get(self, path, model_format=None, custom=False):
+    """Returns the loaded model of path, loads and warms it up if it is not cached"""
+    model_format = model_format or detect_format(path)
+    key = (os.path.abspath(path), model_format)
+    with self.lock:
+      if key in self.models:
+        self.models.move_to_end(key)
+        self.stats[key]["hits"] += 1
+        return self.models[key]
+
+      start = time.perf_counter()
+      model = load_model_file(path, model_format, custom, self.batch_size)
+      load_sec = time.perf_counter() - start
+      warmup_sec = warm_up(model, self.warmup_batch_sizes)
+      stats = self.stats.setdefault(key, {"loads": 0, "hits": 0, "evictions": 0})
+      stats.update(loads=stats["loads"] + 1, load_sec=load_sec, warmup_sec=warmup_sec,
+                   memory_mb=model_files_mb(path, model_format))
+      print(f"Loaded {path} ({model_format}) in {load_sec:.2f} s, warm-up {warmup_sec:.2f} s")
+      self.models[key] = model
+      self.evict()
+      return model
+
+  def memory_mb(self):
+    """Returns the estimated memory of the cached models"""
+    return sum(self.stats[key]["memory_mb"] for key in self.models)
+
+  def evict(self):
+    """Drops the least recently used models until the cached models fit into the memory budget, keeps the newest"""
+    while len(self.models) > 1 and self.memory_mb() > self.memory_budget_mb:
+      key, model = self.models.popitem(last=False)
+      close_model(model)
+      self.stats[key]["evictions"] += 1
+      print(f"Evicted {key[0]} ({key[1]})")
+
+  def clear(self):
+    """Drops all cached models"""
+    with self.lock:
+      for model in self.models.values():
+        close_model(model)
+      self.models.clear()
+
+  def report(self):
+    """Returns a table of loads, cache hits, evictions, last load and warm-up time and memory of every model"""
+    return pd.DataFrame([{"path": path, "format": model_format, "cached": (path, model_format) in self.models, **stats}
+                         for (path, model_format), stats in self.stats.items()])
+
+# registry of get_model
+default_registry = ModelRegistry()
+
+def get_model(path, model_format=None, custom=False):
+  """Returns the model of path from the default registry"""
+  return default_registry.get(path, model_format, custom)
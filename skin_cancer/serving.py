@@ -0,0 +1,161 @@
+"""
+A small local http server which predicts posted jpeg images.
+Concurrent requests are collected into one batch until the batch is full or the oldest request waited max_latency_ms, so every batch needs a single forward pass.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+import numpy as np
+
+from skin_cancer.config import BATCH_SIZE, CLASSES, CLASSNAMES
+from skin_cancer.preprocessing import decode_img
+from skin_cancer.tflite import TFLitePredictor
+
+def make_predictor(model, num_threads=None, batch_size=BATCH_SIZE):
+  """Returns a keras model or a TFLitePredictor of the path of a tflite model, both predict with predict_on_batch"""
+  if not isinstance(model, str):
+    return model
+  return TFLitePredictor(model, num_workers=1, num_threads=num_threads, batch_size=batch_size)
+
+class InferenceServer:
+  """
+  Serves class probabilities of posted jpeg images and predicts concurrent requests in dynamic batches.
+  predictor is a keras model or TFLitePredictor, it is closed with the server.
+  """
+
+  def __init__(self, predictor, max_batch_size=BATCH_SIZE, max_latency_ms=10, max_queue=1024, decode_workers=4):
+    self.predictor = predictor
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency_ms / 1000
+    self.max_queue = max_queue
+    self.decode_pool = concurrent.futures.ThreadPoolExecutor(decode_workers)
+    # a single thread runs the forward passes, so the model is never called concurrently
+    self.predict_pool = concurrent.futures.ThreadPoolExecutor(1)
+    self.queue = None
+    self.requests = 0
+    self.rejected = 0
+    self.batch_sizes = collections.Counter()
+    self.max_queue_depth = 0
+    self.latencies = collections.deque(maxlen=10000)
+
+  async def predict(self, image_bytes):
+    """Decodes jpeg bytes, waits for the batched prediction and returns the class probabilities"""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    image = await loop.run_in_executor(self.decode_pool, lambda: decode_img(image_bytes).numpy())
+    future = loop.create_future()
+    self.queue.put_nowait((image, future))
+    self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+    probabilities = await future
+    self.latencies.append(time.perf_counter() - start)
+    return probabilities
+
+  async def batch_predictions(self):
+    """Collects queued images into batches and runs one forward pass per batch"""
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.max_latency
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      images = np.stack([image for image, future in batch])
+      self.batch_sizes[len(batch)] += 1
+      try:
+        predictions = await loop.run_in_executor(self.predict_pool, self.predictor.predict_on_batch, images)
+      except Exception as e:
+        for image, future in batch:
+          future.set_exception(e)
+        continue
+      for (image, future), prediction in zip(batch, np.asarray(predictions)):
+        future.set_result(prediction)
+
+  def metrics(self):
+    """Returns request, batch size, queue depth and latency metrics"""
+    num_batches = sum(self.batch_sizes.values())
+    latencies = np.array(self.latencies) * 1000
+    return {"requests": self.requests,
+            "rejected": self.rejected,
+            "batches": num_batches,
+            "mean_batch_size": sum(size * count for size, count in self.batch_sizes.items()) / max(num_batches, 1),
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "latency_ms": {f"p{q}": float(np.percentile(latencies, q)) if len(latencies) else None
+                           for q in (50, 90, 99)}}
+
+  async def handle(self, reader, writer):
+    """Handles a http request: POST /predict with a jpeg body or GET /metrics"""
+    status, body = 200, {}
+    try:
+      request_line = (await reader.readline()).decode("latin-1").split()
+      headers = {}
+      while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+          break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+      method, path = request_line[:2]
+      if method == "GET" and path == "/metrics":
+        body = self.metrics()
+      elif method == "POST" and path == "/predict":
+        image_bytes = await reader.readexactly(int(headers.get("content-length", 0)))
+        self.requests += 1
+        if self.queue.qsize() >= self.max_queue:
+          self.rejected += 1
+          status, body = 503, {"error": "queue full"}
+        else:
+          probabilities = await self.predict(image_bytes)
+          label = CLASSES[probabilities.argmax()]
+          body = {"label": label,
+                  "name": CLASSNAMES[label],
+                  "probabilities": {c: float(p) for c, p in zip(CLASSES, probabilities)}}
+      else:
+        status, body = 404, {"error": "not found"}
+    except Exception as e:
+      status, body = 400, {"error": str(e)}
+
+    content = json.dumps(body).encode()
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(content)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + content)
+    await writer.drain()
+    writer.close()
+
+  async def serve(self, host="127.0.0.1", port=8501):
+    """Starts the batching task and serves http requests until cancelled, then closes the server"""
+    self.queue = asyncio.Queue()
+    batcher = asyncio.create_task(self.batch_predictions())
+    server = await asyncio.start_server(self.handle, host, port)
+    print(f"Serving on http://{host}:{port}")
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      batcher.cancel()
+      self.close()
+
+  def close(self):
+    """Shuts down the decode and predict threads and closes a predictor which has a close method"""
+    self.decode_pool.shutdown(wait=True)
+    self.predict_pool.shutdown(wait=True)
+    if hasattr(self.predictor, "close"):
+      self.predictor.close()
+
+def serve_model(model, host="127.0.0.1", port=8501, max_batch_size=BATCH_SIZE, **kwargs):
+  """Serves a keras model or the path of a tflite model until interrupted"""
+  predictor = make_predictor(model, batch_size=max_batch_size)
+  asyncio.run(InferenceServer(predictor, max_batch_size, **kwargs).serve(host, port))
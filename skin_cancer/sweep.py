@@ -0,0 +1,158 @@
+"""
+Hyperparameter sweep with successive halving.
+Trials are sampled from a search space of the data size, batch size, epochs, patience and hub model,
+or the layer widths and dropout of the custom model for model_url None.
+They run on a pool of worker processes, each limited to threads_per_trial cpu threads, so a sweep keeps all cores busy.
+All trials train for the first rung, a 1/eta^(num_rungs - 1) fraction of their num_epochs, only the best 1/eta
+continue to the next rung with eta times the epochs, until the last trials train for their full num_epochs.
+A trial continues from its checkpoint of the previous rung. Every rung of every trial is a row of the results csv.
+"""
+
+import concurrent.futures
+import datetime
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.callbacks import (PATIENCE, CheckpointCallback, create_checkpoint, create_early_stopping,
+                                   restore_checkpoint)
+from skin_cancer.config import PATHS
+from skin_cancer.data import SIZE, SPLIT_PATH, load_or_create_split, prepare_data
+from skin_cancer.models import MODEL_URL, create_custom_model, create_model
+from skin_cancer.pipeline import create_batches, create_train_data, steps_per_epoch, training_size
+from skin_cancer.training import NUM_EPOCHS
+
+# model_url None is the custom model, filters, dense_units and dropout only apply to it
+SEARCH_SPACE = {
+    "size": [SIZE],
+    "batch_size": [16, 32, 64],
+    "num_epochs": [NUM_EPOCHS],
+    "patience": [10, PATIENCE],
+    "model_url": [None, MODEL_URL],
+    "filters": [(32, 32, 64), (32, 64, 128), (64, 64, 128)],
+    "dense_units": [64, 128, 256],
+    "dropout": [0.2, 0.35, 0.5],
+}
+CUSTOM_PARAMS = ["filters", "dense_units", "dropout"]
+NUM_TRIALS = 9
+NUM_RUNGS = 3
+ETA = 3
+THREADS_PER_TRIAL = 2
+SWEEP_SEED = 42
+SWEEP_DIR = PATHS["sweeps"]
+
+def sample_trials(search_space=SEARCH_SPACE, num_trials=NUM_TRIALS, seed=SWEEP_SEED):
+  """Returns up to num_trials distinct random parameter dicts of the search space"""
+  rng = np.random.default_rng(seed)
+  trials = []
+  for attempt in range(100 * num_trials):
+    params = {name: values[rng.integers(len(values))] for name, values in search_space.items()}
+    if params.get("model_url") is not None:
+      params.update({name: None for name in CUSTOM_PARAMS if name in params})
+    if params not in trials:
+      trials.append(params)
+    if len(trials) == num_trials:
+      break
+  return trials
+
+def rung_epochs(num_epochs, rung, num_rungs=NUM_RUNGS, eta=ETA):
+  """Returns the epochs a trial with num_epochs has trained after rung"""
+  return max(1, round(num_epochs / eta ** (num_rungs - 1 - rung)))
+
+def build_trial_model(params):
+  """Returns the compiled model of the trial parameters"""
+  if params.get("model_url") is None:
+    return create_custom_model(**{name: params[name] for name in CUSTOM_PARAMS if params.get(name) is not None})
+  return create_model(model_url=params["model_url"])
+
+# set in every worker process by init_worker
+worker_state = {}
+
+def init_worker(metadata, img_dir, split_path, threads):
+  """Limits the cpu threads of the worker process and keeps the metadata for its trials"""
+  os.environ["OMP_NUM_THREADS"] = str(threads)
+  tf.config.threading.set_intra_op_parallelism_threads(threads)
+  tf.config.threading.set_inter_op_parallelism_threads(threads)
+  worker_state.update(metadata=metadata, img_dir=img_dir, split_path=split_path, threads=threads)
+
+def run_trial(params, epochs, trial_dir):
+  """
+  Trains the trial until epochs, continuing from its checkpoint in trial_dir,
+  and returns its best validation accuracy, epochs and whether early stopping ended it.
+  """
+  tf.keras.backend.clear_session()
+  start = time.perf_counter()
+  training_data = prepare_data(worker_state["metadata"], worker_state["img_dir"], size=params["size"],
+                               split_path=worker_state["split_path"])
+  model = build_trial_model(params)
+  early_stopping = create_early_stopping(params["patience"])
+  checkpoint, manager = create_checkpoint(model, trial_dir, max_to_keep=1)
+  initial_epoch = restore_checkpoint(checkpoint, manager, early_stopping)
+
+  options = tf.data.Options()
+  options.threading.private_threadpool_size = worker_state["threads"]
+  batch_size = params["batch_size"]
+  X_val, y_val = training_data["X_val"], training_data["y_val"]
+  model.fit(create_train_data(training_data, size=batch_size, initial_epoch=initial_epoch).with_options(options),
+            steps_per_epoch=steps_per_epoch(training_size(training_data), batch_size),
+            validation_data=create_batches(X_val, y_val, valid_data=True, size=batch_size).with_options(options),
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            callbacks=[early_stopping, CheckpointCallback(checkpoint, manager, early_stopping)],
+            verbose=0)
+  return {"val_accuracy": float(checkpoint.early_stopping_best.numpy()), "epochs": int(checkpoint.epoch.numpy()),
+          "stopped": bool(early_stopping.stopped_epoch), "train_sec": time.perf_counter() - start}
+
+def run_sweep(metadata, img_dir=PATHS["images"], search_space=SEARCH_SPACE, num_trials=NUM_TRIALS,
+              num_rungs=NUM_RUNGS, eta=ETA, threads_per_trial=THREADS_PER_TRIAL, num_workers=None,
+              split_path=SPLIT_PATH, sweep_dir=SWEEP_DIR, seed=SWEEP_SEED):
+  """
+  Runs a successive halving sweep of num_trials trials of the search space on num_workers processes
+  (default: the cpu cores divided by threads_per_trial) and returns a table of the last rung of every trial,
+  best first. The results of every rung and the checkpoints are written to a new directory below sweep_dir.
+  Trials stopped early by their patience keep their rank, but do not train further.
+  """
+  num_workers = num_workers or max(1, os.cpu_count() // threads_per_trial)
+  sweep_dir = os.path.join(sweep_dir, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+  os.makedirs(sweep_dir)
+  results_path = os.path.join(sweep_dir, "results.csv")
+  # the workers read the split, it is created once before they start
+  load_or_create_split(metadata, split_path)
+
+  trials = sample_trials(search_space, num_trials, seed)
+  columns = ["trial", "rung", *trials[0], "status", "val_accuracy", "epochs", "stopped", "train_sec", "error"]
+  print(f"Sweeping {len(trials)} trials on {num_workers} workers with {threads_per_trial} threads each")
+  latest = {}
+  active = list(range(len(trials)))
+  # spawn, since tensorflow does not support forking a process which already uses it
+  with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=init_worker,
+                                              initargs=(metadata, img_dir, split_path, threads_per_trial)) as pool:
+    for rung in range(num_rungs):
+      futures = {pool.submit(run_trial, trials[trial], rung_epochs(trials[trial]["num_epochs"], rung, num_rungs, eta),
+                             os.path.join(sweep_dir, f"trial_{trial:03d}")): trial
+                 for trial in active if not latest.get(trial, {}).get("stopped")}
+      for future in concurrent.futures.as_completed(futures):
+        trial = futures[future]
+        row = {"trial": trial, "rung": rung, **trials[trial]}
+        try:
+          row.update(status="ok", **future.result())
+        except Exception as error:
+          row.update(status="failed", error=repr(error), val_accuracy=np.nan)
+        pd.DataFrame([row], columns=columns).to_csv(results_path, mode="a", header=not latest, index=False)
+        latest[trial] = row
+        print(f"Rung {rung}, trial {trial}: {row['status']}, val_accuracy {row['val_accuracy']:.4f}")
+
+      # the best 1/eta of the trials continue, failed trials never do
+      ranked = sorted((trial for trial in active if not np.isnan(latest[trial]["val_accuracy"])),
+                      key=lambda trial: latest[trial]["val_accuracy"], reverse=True)
+      active = ranked[:max(1, len(active) // eta)]
+
+  report = pd.DataFrame(latest.values(), columns=columns)
+  report = report.sort_values("val_accuracy", ascending=False).reset_index(drop=True)
+  print(f"Saved sweep results to {results_path}")
+  return report
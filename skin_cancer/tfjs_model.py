@@ -0,0 +1,235 @@
+"""
+Loading of tfjs layers-models without the tensorflowjs converter.
+The weight shards of the weightsManifest are memory mapped and a weight is only read when it is accessed by name,
+e.g. the dense head without the backbone. The keras model is rebuilt from the Sequential topology and its variables
+are assigned from the mapped shards, without reading all shards into one buffer first.
+Replacing weights of the same shape, e.g. a retrained 7-class head, only rewrites the shards which contain them.
+"""
+
+import collections.abc
+import json
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+# dtypes of the weights and of quantized weights in the shards
+TFJS_DTYPES = {"float32": np.float32, "float16": np.float16, "int32": np.int32, "uint8": np.uint8,
+               "uint16": np.uint16, "bool": np.bool_, "complex64": np.complex64}
+
+def model_json_path(path):
+  """Returns the model.json of a tfjs model directory or path itself"""
+  return os.path.join(path, "model.json") if os.path.isdir(path) else path
+
+def read_model_json(path):
+  """Returns the parsed model.json of a tfjs layers-model"""
+  with open(model_json_path(path)) as f:
+    model_json = json.load(f)
+  if model_json.get("format", "layers-model") != "layers-model":
+    raise ValueError(f"Not a tfjs layers-model: {model_json['format']}")
+  return model_json
+
+class TFJSWeights(collections.abc.Mapping):
+  """
+  Read only mapping of the weight names of a tfjs weightsManifest to numpy arrays.
+  The shards of every group are memory mapped, an array is a view of its shard unless it spans two shards
+  or is quantized, then only its own bytes are copied or dequantized.
+  """
+
+  def __init__(self, path, model_json=None):
+    model_json = model_json or read_model_json(path)
+    self.directory = os.path.dirname(model_json_path(path))
+    self.groups = []
+    self.shards = {}
+    self.specs = {}
+    for group_index, group in enumerate(model_json["weightsManifest"]):
+      shards = []
+      for shard_path in group["paths"]:
+        shard_path = os.path.join(self.directory, shard_path)
+        if not os.path.exists(shard_path):
+          raise FileNotFoundError(f"Missing weight shard: {shard_path}")
+        shards.append(np.memmap(shard_path, dtype=np.uint8, mode="r"))
+      self.shards.update(zip(group["paths"], shards))
+      self.groups.append({"paths": group["paths"], "shards": shards,
+                          "starts": np.cumsum([0] + [len(shard) for shard in shards])})
+      # the weights of a group are stored one after the other across its shards
+      offset = 0
+      for spec in group["weights"]:
+        nbytes = weight_nbytes(spec)
+        self.specs[spec["name"]] = dict(spec, group=group_index, offset=offset, nbytes=nbytes)
+        offset += nbytes
+      if offset > self.groups[-1]["starts"][-1]:
+        raise ValueError(f"The shards of weight group {group_index} are smaller than its weights")
+
+  def __getitem__(self, name):
+    spec = self.specs[name]
+    quantization = spec.get("quantization")
+    stored_dtype = TFJS_DTYPES[quantization["dtype"] if quantization else spec["dtype"]]
+    values = np.frombuffer(self.read(spec["group"], spec["offset"], spec["nbytes"]), stored_dtype)
+    values = values.reshape(spec["shape"])
+    if quantization is None:
+      return values
+    if quantization["dtype"] == "float16":
+      return values.astype(np.float32)
+    values = values * np.float32(quantization["scale"]) + np.float32(quantization["min"])
+    if spec["dtype"] != "float32":
+      return np.round(values).astype(TFJS_DTYPES[spec["dtype"]])
+    return values
+
+  def __iter__(self):
+    return iter(self.specs)
+
+  def __len__(self):
+    return len(self.specs)
+
+  def shape(self, name):
+    """Returns the shape of a weight without reading it"""
+    return tuple(self.specs[name]["shape"])
+
+  def read(self, group, offset, nbytes):
+    """Returns nbytes of the shards of group from offset, a view if they are in one shard"""
+    shards, starts = self.groups[group]["shards"], self.groups[group]["starts"]
+    index = np.searchsorted(starts, offset, side="right") - 1
+    if offset + nbytes <= starts[index + 1]:
+      return shards[index][offset - starts[index]:offset - starts[index] + nbytes]
+    pieces = []
+    while nbytes > 0:
+      piece = shards[index][offset - starts[index]:offset - starts[index] + nbytes]
+      pieces.append(piece)
+      offset += len(piece)
+      nbytes -= len(piece)
+      index += 1
+    return np.concatenate(pieces)
+
+  def shard_ranges(self, name):
+    """Yields the shard path, start and end of the bytes of a weight in each shard it spans"""
+    spec = self.specs[name]
+    group = self.groups[spec["group"]]
+    start, end = spec["offset"], spec["offset"] + spec["nbytes"]
+    for path, shard_start, shard_end in zip(group["paths"], group["starts"][:-1], group["starts"][1:]):
+      if start < shard_end and end > shard_start:
+        yield path, max(start, shard_start) - shard_start, min(end, shard_end) - shard_start
+
+def weight_nbytes(spec):
+  """Returns the size in the shards of a weight of the manifest"""
+  dtype = spec.get("quantization", {}).get("dtype", spec["dtype"])
+  if dtype not in TFJS_DTYPES:
+    raise ValueError(f"Unsupported weight dtype: {dtype}")
+  return int(np.prod(spec["shape"], dtype=np.int64)) * np.dtype(TFJS_DTYPES[dtype]).itemsize
+
+def topology_config(model_json):
+  """Returns the keras config of the model of a parsed model.json"""
+  model_config = model_json["modelTopology"]
+  return model_config.get("model_config", model_config)
+
+def topology_layers(model_json):
+  """Returns the input layer config and the configs of the other layers of a Sequential topology"""
+  model_config = topology_config(model_json)
+  if model_config["class_name"] != "Sequential":
+    raise ValueError(f"Only Sequential models are supported, not {model_config['class_name']}")
+  layers = model_config["config"]["layers"]
+  if layers[0]["class_name"] != "InputLayer":
+    raise ValueError("The topology has no InputLayer")
+  return layers[0]["config"], layers[1:]
+
+def build_tfjs_model(model_json):
+  """Returns the uninitialized keras model of the Sequential topology of a parsed model.json"""
+  input_config, layer_configs = topology_layers(model_json)
+  custom_objects = {}
+  if any(config["class_name"] == "KerasLayer" for config in layer_configs):
+    import tensorflow_hub as hub
+    custom_objects["KerasLayer"] = hub.KerasLayer
+  layers = [tf.keras.Input(shape=input_config["batch_input_shape"][1:], dtype=input_config.get("dtype", "float32"),
+                           name=input_config["name"])]
+  for config in layer_configs:
+    layer_class = custom_objects.get(config["class_name"]) or getattr(tf.keras.layers, config["class_name"])
+    layers.append(layer_class.from_config(config["config"]))
+  return tf.keras.Sequential(layers, name=topology_config(model_json)["config"].get("name"))
+
+def variable_weight_name(layer, variable):
+  """Returns the manifest name of a layer variable, hub layers keep the names of their saved model variables"""
+  name = variable.name.split(":")[0]
+  return name if "/" in name else f"{layer.name}/{name}"
+
+def assign_tfjs_weights(model, weights):
+  """Assigns the variables of every layer of model from the weights mapping of manifest names to arrays"""
+  missing = []
+  for layer in model.layers:
+    for variable in layer.weights:
+      name = variable_weight_name(layer, variable)
+      if name not in weights:
+        missing.append(name)
+      else:
+        variable.assign(weights[name])
+  if missing:
+    raise ValueError(f"{len(missing)} weights are missing in the manifest, e.g. {missing[:3]}")
+
+def load_tfjs_model(path):
+  """Returns the keras model of a tfjs layers-model (its model.json or directory) with the weights of its shards"""
+  model_json = read_model_json(path)
+  model = build_tfjs_model(model_json)
+  assign_tfjs_weights(model, TFJSWeights(path, model_json))
+  return model
+
+def tfjs_to_tflite(path, tflite_path="scc_model.tflite", quantization=None, calibration_images=None):
+  """Converts a tfjs layers-model to a tflite model with the quantization of export_tflite"""
+  from skin_cancer.export import export_tflite
+  return export_tflite(load_tfjs_model(path), tflite_path, quantization, calibration_images)
+
+def head_weight_names(model_json):
+  """Returns the manifest names of the kernel and bias of the last layer of the topology"""
+  input_config, layer_configs = topology_layers(model_json)
+  head = layer_configs[-1]["config"]["name"]
+  return f"{head}/kernel", f"{head}/bias"
+
+def write_tfjs_weights(path, new_weights, output_dir=None):
+  """
+  Replaces weights of a tfjs layers-model by arrays of the same shape and dtype.
+  Only the shards which contain them are rewritten, the others are hard linked (or copied) to output_dir.
+  Without output_dir the shards are replaced in place. Returns the rewritten shard paths.
+  """
+  model_json = read_model_json(path)
+  weights = TFJSWeights(path, model_json)
+  output_dir = output_dir or weights.directory
+  os.makedirs(output_dir, exist_ok=True)
+
+  patches = collections.defaultdict(list)
+  for name, values in new_weights.items():
+    spec = weights.specs[name]
+    if "quantization" in spec:
+      raise ValueError(f"Writing quantized weights is not supported: {name}")
+    values = np.asarray(values)
+    if values.shape != weights.shape(name):
+      raise ValueError(f"Shape {values.shape} of {name} does not match {weights.shape(name)}")
+    data = values.astype(TFJS_DTYPES[spec["dtype"]]).tobytes()
+    position = 0
+    for shard_path, start, end in weights.shard_ranges(name):
+      patches[shard_path].append((start, data[position:position + end - start]))
+      position += end - start
+
+  for group in model_json["weightsManifest"]:
+    for shard_path in group["paths"]:
+      source, target = os.path.join(weights.directory, shard_path), os.path.join(output_dir, shard_path)
+      if shard_path in patches:
+        shard = bytearray(weights.shards[shard_path])
+        for start, data in patches[shard_path]:
+          shard[start:start + len(data)] = data
+        # write to a temporary file first, so readers of the old shard keep a complete file
+        with open(target + ".tmp", "wb") as f:
+          f.write(shard)
+        os.replace(target + ".tmp", target)
+      elif os.path.abspath(source) != os.path.abspath(target):
+        try:
+          os.link(source, target)
+        except OSError:
+          shutil.copyfile(source, target)
+  if os.path.abspath(output_dir) != os.path.abspath(weights.directory):
+    shutil.copyfile(model_json_path(path), os.path.join(output_dir, os.path.basename(model_json_path(path))))
+  return [os.path.join(output_dir, shard_path) for shard_path in patches]
+
+def swap_tfjs_head(path, head, output_dir=None):
+  """Replaces the weights of the last layer of a tfjs layers-model by the kernel and bias of a keras Dense layer"""
+  kernel, bias = head.get_weights()
+  kernel_name, bias_name = head_weight_names(read_model_json(path))
+  return write_tfjs_weights(path, {kernel_name: kernel, bias_name: bias}, output_dir)
@@ -0,0 +1,130 @@
+"""
+TFLite inference.
+The predictor keeps a pool of tflite interpreters, one per worker thread, with their input tensors allocated once for batch_size images.
+"""
+
+import collections
+import concurrent.futures
+import queue
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer.config import BATCH_SIZE, IMG_SIZE
+
+class TFLitePredictor:
+  """Predicts images with a pool of tflite interpreters and the same interface as model.predict"""
+
+  def __init__(self, model_path, num_workers=4, num_threads=1, batch_size=BATCH_SIZE):
+    self.model_path = model_path
+    self.batch_size = batch_size
+    self.num_workers = num_workers
+    self.interpreters = queue.Queue()
+    for worker in range(num_workers):
+      interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+      input_index = interpreter.get_input_details()[0]["index"]
+      interpreter.resize_tensor_input(input_index, [batch_size, IMG_SIZE, IMG_SIZE, 3])
+      interpreter.allocate_tensors()
+      self.interpreters.put(interpreter)
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    self.input_index = input_index
+    self.input_dtype = input_details["dtype"]
+    self.input_quantization = input_details["quantization"]
+    self.output_index = output_details["index"]
+    self.output_quantization = output_details["quantization"] if output_details["dtype"] != np.float32 else None
+    self.pool = concurrent.futures.ThreadPoolExecutor(num_workers)
+    self.closed = False
+
+  def predict_on_batch(self, images):
+    """Predicts at most batch_size images with the next free interpreter"""
+    if self.closed:
+      raise RuntimeError(f"The predictor of {self.model_path} is closed")
+    num_images = len(images)
+    if self.input_dtype != np.float32:
+      scale, zero_point = self.input_quantization
+      info = np.iinfo(self.input_dtype)
+      images = np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(self.input_dtype)
+    interpreter = self.interpreters.get()
+    try:
+      # write into the allocated input tensor, the rest of a partial batch keeps old images
+      interpreter.tensor(self.input_index)()[:num_images] = images
+      interpreter.invoke()
+      predictions = interpreter.get_tensor(self.output_index)[:num_images]
+    finally:
+      self.interpreters.put(interpreter)
+    if self.output_quantization is not None:
+      scale, zero_point = self.output_quantization
+      predictions = (predictions.astype(np.float32) - zero_point) * scale
+    return predictions
+
+  def batches(self, data):
+    """Yields image arrays of at most batch_size from an image array or batches of create_batches"""
+    if isinstance(data, np.ndarray):
+      data = [data]
+    else:
+      data = (batch[0] if isinstance(batch, tuple) else batch for batch in data.as_numpy_iterator())
+    for images in data:
+      for start in range(0, len(images), self.batch_size):
+        yield images[start:start + self.batch_size]
+
+  def predict(self, data, verbose=0):
+    """Returns the predictions of all images, every worker predicts one batch at a time"""
+    predictions = []
+    pending = collections.deque()
+    for images in self.batches(data):
+      pending.append(self.pool.submit(self.predict_on_batch, images))
+      if len(pending) >= 2 * self.num_workers:
+        predictions.append(pending.popleft().result())
+    predictions.extend(future.result() for future in pending)
+    if verbose:
+      print(f"Predicted {sum(len(p) for p in predictions)} images")
+    return np.concatenate(predictions)
+
+  def close(self):
+    """Shuts down the worker threads and releases the interpreters"""
+    self.closed = True
+    self.pool.shutdown(wait=True)
+    while not self.interpreters.empty():
+      self.interpreters.get_nowait()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def single_image_latency(predict_fn, images):
+  """Returns the mean latency in seconds of predicting images one at a time"""
+  predict_fn(images[:1])  # warm up
+  start = time.perf_counter()
+  for image in images:
+    predict_fn(image[np.newaxis])
+  return (time.perf_counter() - start) / len(images)
+
+def predictor_speed(name, predictor, predict_fn, images, data):
+  """Returns the single image latency of predict_fn on images and the images/sec of predictor.predict on data"""
+  latency = single_image_latency(predict_fn, images)
+  start = time.perf_counter()
+  num_images = len(predictor.predict(data, verbose=0))
+  throughput = num_images / (time.perf_counter() - start)
+  print(f"{name}: {latency * 1000:.1f} ms per image, {throughput:.1f} images/sec")
+  return {"predictor": name, "latency_ms": latency * 1000, "images_per_sec": throughput}
+
+def benchmark_tflite(model, tflite_path, data, num_workers=(1, 2, 4), num_threads=1, num_single=50):
+  """
+  Compares per image latency and throughput of the keras model and tflite predictors with different worker counts.
+  data is a batched dataset from create_batches.
+  """
+  images = np.concatenate([batch[0] if isinstance(batch, tuple) else batch
+                           for batch in data.take(int(np.ceil(num_single / BATCH_SIZE))).as_numpy_iterator()])[:num_single]
+  # single images are predicted by the keras model and a tflite interpreter allocated for batches of 1
+  with TFLitePredictor(tflite_path, 1, num_threads, batch_size=1) as single_predictor:
+    results = [predictor_speed("keras", model, model.predict_on_batch, images, data)]
+    for workers in num_workers:
+      with TFLitePredictor(tflite_path, workers, num_threads) as predictor:
+        results.append(predictor_speed(f"tflite {workers} workers", predictor, single_predictor.predict_on_batch,
+                                       images, data))
+  return pd.DataFrame(results)
@@ -0,0 +1,180 @@
+"""
+Training of the models on the prepare_data dict.
+train_model takes a tf.distribute strategy, e.g. MultiWorkerMirroredStrategy with one process per node
+and the cluster described in the TF_CONFIG environment variable of every process.
+It resumes from the latest checkpoint of checkpoint_dir, use a new directory for a new training.
+Under a strategy the model trains with fit_distributed, a loop of strategy.run steps with the callbacks of fit.
+"""
+
+import datetime
+import functools
+import os
+
+import tensorflow as tf
+
+from skin_cancer.callbacks import (CHECKPOINT_DIR, LOG_DIR, PATIENCE, CheckpointCallback, create_checkpoint,
+                                   create_early_stopping, create_tensorboard_callback, restore_checkpoint,
+                                   save_training_data, worker_checkpoint_dir)
+from skin_cancer.config import BATCH_SIZE, PATHS
+from skin_cancer.models import LEARNING_RATE, create_custom_model, create_model
+from skin_cancer.pipeline import create_batches, create_train_data, steps_per_epoch, training_size
+from skin_cancer.profiling import PROFILE, PROFILE_STEPS, ProfilingCallback, data_throughput, write_profile_summary
+
+NUM_EPOCHS = 50
+MODEL_DIR = PATHS["models"]
+
+# function to train the model
+def train_model(training_data, custom=False, strategy=None, checkpoint_dir=CHECKPOINT_DIR, profile=PROFILE,
+                epochs=NUM_EPOCHS, patience=PATIENCE, log_dir=LOG_DIR, callbacks=()):
+  """
+  returns model trained on the training and validation data of the prepare_data dict
+  With a tf.distribute strategy the model is built in its scope, every worker reads its own shard
+  of the training and validation data, and batch size and learning rate are scaled by the number of replicas.
+  The training state is checkpointed to checkpoint_dir and the training resumes from its latest checkpoint.
+  profile=True writes a profile summary and a profiler trace to the tensorboard logs.
+  callbacks are added to the tensorboard, early stopping and checkpoint callbacks.
+  """
+  if strategy is None:
+    strategy = tf.distribute.get_strategy()
+  distributed = strategy is not tf.distribute.get_strategy()
+  num_replicas = strategy.num_replicas_in_sync
+  checkpoint_dir = worker_checkpoint_dir(strategy, checkpoint_dir)
+  early_stopping = create_early_stopping(patience)
+  with strategy.scope():
+    if custom:
+      model = create_custom_model(learning_rate=LEARNING_RATE * num_replicas)
+    else:
+      model = create_model(learning_rate=LEARNING_RATE * num_replicas)
+    checkpoint, manager = create_checkpoint(model, checkpoint_dir)
+    initial_epoch = restore_checkpoint(checkpoint, manager, early_stopping)
+  if initial_epoch == 0:
+    save_training_data(training_data, checkpoint_dir)
+
+  X_val, y_val = training_data["X_val"], training_data["y_val"]
+  if not distributed:
+    fit_data = dict(x=create_train_data(training_data, initial_epoch=initial_epoch),
+                    steps_per_epoch=steps_per_epoch(training_size(training_data)),
+                    validation_data=create_batches(X_val, y_val, valid_data=True))
+  else:
+    global_size = BATCH_SIZE * num_replicas
+    fit_data = dict(x=distribute_batches(strategy, functools.partial(create_train_data, training_data,
+                                                                     initial_epoch=initial_epoch),
+                                         global_size),
+                    steps_per_epoch=steps_per_epoch(training_size(training_data), global_size),
+                    validation_data=distribute_batches(strategy, functools.partial(create_batches, X_val, y_val, valid_data=True),
+                                                       global_size, steps=steps_per_epoch(len(X_val), global_size)),
+                    validation_steps=steps_per_epoch(len(X_val), global_size))
+  tensorboard = create_tensorboard_callback(profile_batch=PROFILE_STEPS if profile else 0, log_dir=log_dir)
+  callbacks = [tensorboard, early_stopping, CheckpointCallback(checkpoint, manager, early_stopping), *callbacks]
+  if profile:
+    profiler = ProfilingCallback()
+    callbacks.append(profiler)
+    data_batches_per_sec = data_throughput(fit_data["x"])
+  if not distributed:
+    model.fit(epochs=epochs,
+              initial_epoch=initial_epoch,
+              validation_freq=1,
+              callbacks=callbacks,
+              **fit_data)
+  else:
+    fit_distributed(model, strategy, epochs=epochs, initial_epoch=initial_epoch, callbacks=callbacks, **fit_data)
+
+  if profile:
+    summary = profiler.summary()
+    summary["data_batches_per_sec"] = data_batches_per_sec
+    summary["input_bound"] = bool(data_batches_per_sec < summary["steps_per_sec"])
+    write_profile_summary(summary, tensorboard.log_dir)
+  return model
+
+def fit_distributed(model, strategy, x, steps_per_epoch, validation_data, validation_steps, epochs,
+                    initial_epoch=0, callbacks=()):
+  """
+  Trains the compiled model like model.fit on the batches of distribute_batches, with a loop of strategy.run steps.
+  Keras 3 fit fails under MultiWorkerMirroredStrategy with more than one worker, since it reduces a whole
+  data batch across the workers to build the model. The loss and accuracy of the validation batches are averaged
+  with their sample weights, so the zero weighted images which pad them do not count.
+  """
+  # per image losses, the loop reduces them itself
+  loss_fn = model.loss.__class__.from_config({**model.loss.get_config(), "reduction": None})
+  sparse = isinstance(model.loss, tf.keras.losses.SparseCategoricalCrossentropy)
+  with strategy.scope():
+    metrics = {"loss": tf.keras.metrics.Mean(), "accuracy": tf.keras.metrics.SparseCategoricalAccuracy() if sparse
+               else tf.keras.metrics.CategoricalAccuracy()}
+    val_metrics = {"val_loss": tf.keras.metrics.Mean(), "val_accuracy": metrics["accuracy"].__class__()}
+
+  @tf.function
+  def train_step(iterator):
+    def step(images, labels):
+      with tf.GradientTape() as tape:
+        predictions = model(images, training=True)
+        losses = loss_fn(labels, predictions)
+        # the gradients of the replicas are summed, so every replica adds its share of the global mean
+        loss = tf.reduce_sum(losses) / tf.cast(tf.shape(losses)[0] * strategy.num_replicas_in_sync, losses.dtype)
+      gradients = tape.gradient(loss, model.trainable_variables)
+      model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+      metrics["loss"].update_state(losses)
+      metrics["accuracy"].update_state(labels, predictions)
+    strategy.run(step, args=next(iterator))
+
+  @tf.function
+  def val_step(iterator):
+    def step(images, labels, weights):
+      predictions = model(images, training=False)
+      val_metrics["val_loss"].update_state(loss_fn(labels, predictions), sample_weight=weights)
+      val_metrics["val_accuracy"].update_state(labels, predictions, sample_weight=weights)
+    strategy.run(step, args=next(iterator))
+
+  callbacks = tf.keras.callbacks.CallbackList(list(callbacks), add_history=True, model=model,
+                                              epochs=epochs, steps=steps_per_epoch)
+  model.stop_training = False
+  train_iterator = iter(x)
+  logs = {}
+  callbacks.on_train_begin()
+  for epoch in range(initial_epoch, epochs):
+    for metric in [*metrics.values(), *val_metrics.values()]:
+      metric.reset_state()
+    callbacks.on_epoch_begin(epoch)
+    for step in range(steps_per_epoch):
+      callbacks.on_train_batch_begin(step)
+      train_step(train_iterator)
+      callbacks.on_train_batch_end(step, {name: float(metric.result()) for name, metric in metrics.items()})
+    val_iterator = iter(validation_data)
+    for step in range(validation_steps):
+      val_step(val_iterator)
+    logs = {name: float(metric.result()) for name, metric in {**metrics, **val_metrics}.items()}
+    callbacks.on_epoch_end(epoch, logs)
+    if model.stop_training:
+      break
+  callbacks.on_train_end(logs)
+  return model.history
+
+def distribute_batches(strategy, create_fn, global_size, steps=None):
+  """
+  Returns the batches of create_fn(size=..., shard=...) distributed with strategy.
+  Every worker creates its own shard with the per replica batch size of global_size.
+  Finite batches are given with their number of global steps, each image then gets a sample weight of 1
+  and the shard is padded with zero weighted images to the steps, so all workers run the same number of steps
+  and every image counts once.
+  """
+  def dataset_fn(input_context):
+    size = input_context.get_per_replica_batch_size(global_size)
+    data = create_fn(size=size, shard=(input_context.num_input_pipelines, input_context.input_pipeline_id))
+    if steps is None:
+      # all replicas need batches of the same shape, so the last batch of an epoch is filled up from the next one
+      return data.rebatch(size, drop_remainder=True)
+    images = data.unbatch().map(lambda image, label: (image, label, tf.constant(1.0)))
+    image_spec, label_spec, weight_spec = images.element_spec
+    padding = tf.data.Dataset.from_tensors((tf.zeros(image_spec.shape, image_spec.dtype),
+                                            tf.zeros(label_spec.shape, label_spec.dtype),
+                                            tf.constant(0.0))).repeat()
+    replicas_per_worker = input_context.num_replicas_in_sync // input_context.num_input_pipelines
+    return images.concatenate(padding).batch(size, drop_remainder=True).take(steps * replicas_per_worker)
+  return strategy.distribute_datasets_from_function(dataset_fn)
+
+def save_model(model, suffix=None, model_dir=MODEL_DIR):
+  modeldir  = os.path.join(model_dir,
+                           datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+  model_path = modeldir + "_" + suffix + ".h5"
+  model.save(model_path)
+  print(f"Model saved to: {model_path}")
+  return model_path
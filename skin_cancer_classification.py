@@ -24,22 +24,40 @@ The models built below with TensorFlow are Deep Learning models (neural networks
 ### Import Modules
 """
 
+
 import os
+import time
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import tensorflow as tf
-import tensorflow_hub as hub
 from IPython.display import Image
 
 print("GPU", "connected" if tf.config.list_physical_devices("GPU") else "not available")
 
+"""The pipeline is the skin_cancer package next to this notebook. Its modules import TensorFlow only when they are used and
+tensorflow_hub, tensorflowjs, matplotlib and seaborn only in the functions which need them, so single functions can be imported cheaply.
+The same steps run from the command line with `python -m skin_cancer prepare|train|evaluate|predict|export --data-root <dir>`.
+"""
+
+from skin_cancer.config import CLASSES, CLASSNAMES, data_paths
+from skin_cancer.data import (image_filepaths, load_metadata, load_or_create_split, metadata_labels, prepare_data,
+                              rebalance)
+from skin_cancer.pipeline import (build_store, create_batches, create_train_data, load_sample_images, load_store,
+                                  benchmark_pipeline, steps_per_epoch, training_size)
+from skin_cancer.plots import (data_distribution, plot_confusion_matrix, plot_predicion_distributions,
+                               plot_prediction, plot_test_predictions, show_img)
+
 """### Import Data"""
 
 #!unzip "/content/drive/My Drive/SkinCancer/HAM10000_images_part_1.zip" -d "/content/drive/My Drive/SkinCancer/train_data"
 #!unzip "/content/drive/My Drive/SkinCancer/HAM10000_images_part_2.zip" -d "/content/drive/My Drive/SkinCancer/train_data"
 
-metadata = pd.read_csv("drive/My Drive/SkinCancer/HAM10000_metadata.csv")
+DATA_ROOT = "drive/My Drive/SkinCancer"
+paths = data_paths(DATA_ROOT)
+
+metadata = load_metadata(paths["metadata"])
 
 metadata.head()
 
@@ -58,13 +76,7 @@ The dx column in metadata describes the diagnoses of the following classes:
 
 np.unique(metadata["dx"])
 
-classnames = {'akiec': "Actinic keratoses", 
-              'bcc': "basal cell carcinoma",
-              'bkl': "benign keratosis-like", 
-              'df': "dermatofibroma",
-              'mel': "melanoma",
-              'nv': "melanocytic nevi",
-              'vasc': "vascular"}
+CLASSNAMES
 
 """## Data Visualisations and Engineering
 
@@ -103,202 +115,86 @@ plt.show()
 """### Imagefiles and Label Data Engineering"""
 
 # check files number
-print("Number of Images","match" if len(os.listdir("drive/My Drive/SkinCancer/train_data/")) == len(metadata) else "do not match", "length of metadata")
+print("Number of Images","match" if len(os.listdir(paths["images"])) == len(metadata) else "do not match", "length of metadata")
 
 # create pathnames from image ID's
-img_filepaths= ["drive/My Drive/SkinCancer/train_data/" + fname + ".jpg" for fname in metadata["image_id"]]
+img_filepaths = image_filepaths(metadata, paths["images"])
 
-# create labels for images
-labels = np.array(metadata["dx"])
-classes = np.unique(labels)
-classes, labels[:2]
+# integer label of each image, classes[label] is its classname
+classes = CLASSES
+labels = metadata_labels(metadata)
+classes, labels[:2], classes[labels[:2]]
 
-# create boolean array for each label
-bool_labels = [label == classes for label in labels]
-bool_labels[:2], bool_labels[0].argmax(), bool_labels[1].argmax()
-
-"""### Train and Validation Data Split"""
-
-# training and validation split
-from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
+"""### Train, Validation and Test Data Split
+Several images can show the same lesion. The split keeps all images of a lesion in the same subset, so validation images never leak into training.
+Every class is split with the same fractions and the indices are cached, so reruns reuse the same split.
+"""
 
 SIZE = 10015 #@param {type:"slider", min:1, max:10015}
+TEST_SIZE = 0.0 #@param {type:"slider", min:0, max:0.3, step:0.05}
 
-X = img_filepaths
-y = bool_labels
-
-X, y = shuffle(X,y)
-
-X = X[:SIZE]
-y = y[:SIZE]
-
-X_train, X_val, y_train, y_val = train_test_split(X,
-                                                  y,
-                                                  test_size=0.15,
-                                                  random_state=42)
+split = load_or_create_split(metadata, paths["split"], test_size=TEST_SIZE)
 
-len(X_train)
+data_distribution(labels[split["train"]], classes)
 
 """
 ### Training Data Balancing
 Balance quantities of classes. Use data augmentation techniques while image preprocessing.
 """
 
-def label_count(y, class_name):
-  """Returns number of labels of a classname"""
-  class_id = np.argmax([class_name == c for c in classes])
-  count=0
-  for label in y:
-    if np.argmax(label) == class_id:
-      count+=1
-  return count
-
-# delete fraction of nv cases from training data to get a more balanced dataset
-def delete_data(X, y, class_name, factor = 0.4):
-  """
-  Deletes fraction of Image, label pairs of a classname to handle data imbalances
-  Factor 0.5 deletes half of the selected data.
-  """
-  class_id = np.argmax([class_name == c for c in classes])
-  start = 0
-  count = 0
-  for num_delete in range (int(factor * label_count(y, class_name))):
-    for i in range(start, len(y)):
-      if np.argmax(y[i]) == class_id:
-        del X[i]
-        del y[i]
-        count +=1
-        start = i
-        break
-  print(f"Deleted {count} items of class {class_name}.")
-  return X,y
-
-def copy_data(X, y, class_name, factor = 1):
-  """
-  Copies Image, label pairs of a classname with factor COPY to handle data imbalances.
-  Factor COPY=1 doubles selected data.
-  """
-  class_id = np.argmax([class_name == c for c in classes])
-  start = 0
-  count = 0
-  for num_copy in range (int(factor * label_count(y, class_name))):
-    for i in range(start, len(y)):
-      if np.argmax(y[i]) == class_id:
-        X.append(X[i])
-        y.append(y[i])
-        count +=1
-        start = i+1
-        break
-  print(f"Copied {count} items of class {class_name}.")
-  return X,y
-
-def data_distribution(y, classes):
-  """creates plot of data distribution"""
-  counts = []
-  for c in classes:
-    counts.append(label_count(y, c))
-  df = pd.DataFrame(data={'class': classes, 'count': counts}).sort_values(by=['count'])
-  df.plot.barh(x='class', 
-               y='count',
-               figsize=(10,6),
-               title="Data Distribution",
-               color=["salmon"]);
-  return None
+# "copy" resamples the training data once, "weights" and "rejection" balance the classes while sampling batches
+BALANCING = "copy" #@param ["copy", "weights", "rejection"]
 
-data_distribution(y_train, classes)
+# use SIZE images of the dataset, BALANCE_FACTORS of skin_cancer.data set the target count of every class
+training_data = prepare_data(metadata, paths["images"], SIZE, paths["split"], BALANCING, test_size=TEST_SIZE)
+X_train, y_train = training_data["X_train"], training_data["y_train"]
+X_val, y_val = training_data["X_val"], training_data["y_val"]
+X_test, y_test = training_data["X_test"], training_data["y_test"]
 
-# delete half of nv cases
-X_train, y_train = delete_data(X_train, y_train, "nv")
-# increase mel and bkl cases by 50%
-X_train, y_train = copy_data(X_train, y_train, "mel", 0.5)
-X_train, y_train = copy_data(X_train, y_train, "bkl", 0.5)
-# double bcc and akiec cases
-X_train, y_train = copy_data(X_train, y_train, "bcc", 1)
-X_train, y_train = copy_data(X_train, y_train, "akiec", 1)
-# triple vasc and df cases
-X_train, y_train = copy_data(X_train, y_train, "vasc", 2)
-X_train, y_train = copy_data(X_train, y_train, "df", 2)
+len(X_train), len(X_val), len(X_test)
 
 data_distribution(y_train, classes)
 
-"""### Image Preprocessing"""
+# rebalancing is vectorized and takes milliseconds on a million labels
+synthetic_labels = np.random.default_rng(0).integers(0, len(classes), size=1_000_000)
+start = time.perf_counter()
+rebalance(synthetic_labels, "oversample")
+print(f"Rebalanced {len(synthetic_labels)} labels in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+"""### Image Preprocessing
+Images are decoded with the DECODE_MODE of skin_cancer.preprocessing: the HAM10000 images are 600x450, more than twice the model input size.
+"ratio" lets the jpeg decoder downscale in the DCT domain, "crop" additionally decodes only the central square.
+Training batches are augmented after decoding and resizing, with stateless seeds of the epoch and image index.
+"""
 
 from matplotlib.pyplot import imread
 image = imread(img_filepaths[7])
 image.shape
 
-# preprocess image to tensor
-IMG_SIZE = 224
-
-def preprocess_img(img_filepath, transform=False):
-  """Takes image and turns it into tensor"""
-  # read img file
-  image = tf.io.read_file(img_filepath)
-  # turn img into tensor
-  image = tf.image.decode_jpeg(image, channels=3)
-  # convert colour channel
-  image = tf.image.convert_image_dtype(image, tf.float32)
-  # transform image
-  if transform:
-    image = tf.image.random_flip_left_right(image, seed=42)
-    image = tf.image.random_flip_up_down(image, seed=42)
-    image = tf.image.random_crop(image, [IMG_SIZE, IMG_SIZE, 3])
-  # resize image
-  image = tf.image.resize(image, size=[IMG_SIZE, IMG_SIZE])
-
-  return image
-
-def preprocessed_img_label_pair(img_filepath, label, transform=False):
-  """Retruns tuple of preprocesed image and its label"""
-  image = preprocess_img(img_filepath, transform)
-  return image, label
-
 """### Image Batching
 Batching is necessary since not all images fit into memory within one batch
 """
 
-BATCH_SIZE = 32
-
-def create_batches(X, y=None, valid_data=False, size=BATCH_SIZE):
-  """Creates batches of X and y pairs. Shuffels train data"""
-  if not y:   # no labels
-    print("Created test data batches")
-    data = tf.data.Dataset.from_tensor_slices((tf.constant(X)))
-    data_batch =data.map(preprocess_img).batch(BATCH_SIZE) 
-
-  elif valid_data:
-    print("Created validation data batches")
-    data = tf.data.Dataset.from_tensor_slices((tf.constant(X),
-                                               tf.constant(y)))
-    data_batch = data.map(preprocessed_img_label_pair).batch(BATCH_SIZE)
-
-  else:
-    print("Created training data batches")
-    data= tf.data.Dataset.from_tensor_slices((tf.constant(X),
-                                              tf.constant(y)))
-    data = data.shuffle(buffer_size=len(X))
-    data_batch = data.map(preprocessed_img_label_pair).batch(BATCH_SIZE)
-
-  return data_batch
-
 # create training and validation batches
-train_data = create_batches(X_train, y_train)
+train_data = create_train_data(training_data)
+train_steps = steps_per_epoch(training_size(training_data))
 val_data = create_batches(X_val, y_val, valid_data=True)
 train_data.element_spec
 
-"""### Image Viualisation"""
+# decode and resize all images once, then read the training and validation batches from the store
+#build_store(metadata, paths["images"], paths["store"])
+#store = load_store(paths["store"])
+#train_data = create_train_data(training_data, store=store)
+#val_data = create_batches(X_val, y_val, valid_data=True, store=store)
+
+"""### Input Pipeline Benchmark
+Measures the throughput of the validation pipeline with different settings on the sample images
+"""
 
-def show_img(images, labels, num=20):
-  """Displays 20 images and their label from a batch"""
-  plt.figure(figsize=(10,10))
+#sample_filepaths, sample_labels = load_sample_images(metadata, paths["sample_zip"], paths["sample_images"])
+#benchmark_pipeline(sample_filepaths, sample_labels)
 
-  # subplots of images with their labels
-  for i in range(num):
-    ax = plt.subplot(5, 5, i+1)
-    plt.imshow(images[i])
-    plt.title(classnames[classes[labels[i].argmax()]])
-    plt.axis("off")
+"""### Image Viualisation"""
 
 train_images, train_labels = next(train_data.as_numpy_iterator())
 show_img(train_images, train_labels)
@@ -308,381 +204,326 @@ show_img(val_images, val_labels)
 
 """## Building the Model
 
-### Model 1 Creation (transfer model)
+### Mixed Precision and XLA
+With MIXED_PRECISION the layers of the custom model compute in bfloat16 and keep float32 weights, the softmax output layer stays float32.
+The transfer model runs the saved float32 graph of the hub model and stays float32.
+It is only used if the hardware has native bfloat16 support. JIT_COMPILE compiles the train and predict steps with XLA.
 """
 
-# use of pretrained model from TensorFlow Hun
-INPUT_SHAPE = [None, IMG_SIZE, IMG_SIZE, 3]
-OUTPUT_SHAPE = len(classes)
-
-#MODEL_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_130_224/classification/4"
-MODEL_URL = "https://tfhub.dev/tensorflow/resnet_50/classification/1"
-
-def create_model(input_shape=INPUT_SHAPE, output_shape=OUTPUT_SHAPE, model_url=MODEL_URL):
-  """Creates, compiles and builds the model. Needs input shape, output shape and model url."""
-  print("Building model with:", model_url)
-
-  # setup model layers
-  model = tf.keras.Sequential([
-    hub.KerasLayer(model_url, trainable=True), # input layer
-    tf.keras.layers.Dense(units=output_shape, activation="softmax") # output layer
-    ])
-  
-  # compile model
-  model.compile(
-      loss=tf.keras.losses.CategoricalCrossentropy(),
-      optimizer=tf.keras.optimizers.Adam(),
-      metrics=["accuracy"]
-      )
-  
-  # build model
-  model.build(input_shape)
-  
-  return model
+from skin_cancer.models import benchmark_precision, create_custom_model, create_model, load_model
 
-# show a blank model 
-model = create_model()
+MIXED_PRECISION = False #@param {type:"boolean"}
+JIT_COMPILE = False #@param {type:"boolean"}
+
+"""### Model 1 Creation (transfer model)"""
+
+# show a blank model of the pretrained resnet from TensorFlow Hub
+model = create_model(mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE)
 model.summary()
 
 """### Model 2 Creation (custom model)"""
 
-INPUT_SHAPE2 = (IMG_SIZE, IMG_SIZE, 3)
-OUTPUT_SHAPE = len(classes)
-
-def create_custom_model(input_shape=INPUT_SHAPE2, output_shape=OUTPUT_SHAPE):
-    """
-    Returns a compiled convolutional neural network model. 
-    """
-    model = tf.keras.models.Sequential([
-        # convolution layer on input (images)
-        tf.keras.layers.Conv2D(
-            32, (3, 3), activation="relu", input_shape=input_shape
-        ),
-
-        # max - pooling layer, 2x2 pool
-        tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
-        
-        # new convolution
-        tf.keras.layers.Conv2D(
-            32, (3, 3), activation="relu"),
-        
-        # new pooling
-        tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
-
-        # new convolution
-        tf.keras.layers.Conv2D(
-            64, (3, 3), activation="relu"),
-
-        # new pooling
-        tf.keras.layers.GlobalAveragePooling2D(),
-
-        # flatten units
-        tf.keras.layers.Flatten(),
-
-        # hidden layer with dropout
-        tf.keras.layers.Dense(128, activation="relu"),
-
-        # dropout layer 
-        tf.keras.layers.Dropout(0.5),
-
-        # output layer
-        tf.keras.layers.Dense(output_shape, activation="softmax")
-    ])
-
-    # compile model
-    model.compile(
-        optimizer="adam",
-        loss="categorical_crossentropy",
-        metrics=["accuracy"]
-    )
-
-    return model
-
 # show a blank model 
-custom_model = create_custom_model()
+custom_model = create_custom_model(mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE)
 custom_model.summary()
 
+"""### Mixed Precision Benchmark
+Measures train and predict steps/sec and the peak memory of the custom model for each precision and XLA setting on random images.
+On cpu the process keeps memory of earlier configs, for exact peak memory benchmark one config per runtime.
+"""
+
+#benchmark_precision()
+
 """### Callbacks"""
 
 # Commented out IPython magic to ensure Python compatibility.
 # %load_ext tensorboard
 
-import datetime
-def create_tensorboard_callback():
-  logdir = os.path.join("drive/My Drive/SkinCancer/logs",
-                        datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
-  return tf.keras.callbacks.TensorBoard(logdir)
-
 # early stopping
 PATIENCE = 25 #@param {type:"slider", min:2, max:100}
-early_stopping = tf.keras.callbacks.EarlyStopping(
-                 monitor="val_accuracy", patience=100)
+
+"""### Checkpoints
+Every epoch the weights, optimizer state, epoch, global random generator and early stopping state are saved,
+only the latest checkpoints are kept. The training batches are indexed by epoch, so the epoch is also the position of the data iterator.
+The prepare_data dict, its filepaths and labels after splitting and balancing, is saved next to the checkpoints.
+train_model resumes from the latest checkpoint of its checkpoint directory, use a new directory for a new training.
+"""
+
+from skin_cancer.callbacks import load_training_data
+
+# continue an interrupted training with its training data instead of splitting and balancing again
+resumed_data = load_training_data(paths["checkpoints"])
+if resumed_data is not None:
+  print(f"Using the training data of {paths['checkpoints']}")
+  training_data = resumed_data
+  X_train, y_train = training_data["X_train"], training_data["y_train"]
+  X_val, y_val = training_data["X_val"], training_data["y_val"]
+  train_data = create_train_data(training_data)
+  train_steps = steps_per_epoch(training_size(training_data))
+  val_data = create_batches(X_val, y_val, valid_data=True)
+
+"""### Profiling
+With PROFILE train_model records the time of every step, the host memory of every epoch and the batches/sec of the
+training data on its own, traces some steps with the TensorFlow profiler (tensorboard profile tab)
+and writes a json summary next to its tensorboard logs.
+profile_training splits single training steps into the wait for the next batch and the compute of the step,
+and measures the throughput of the pipeline stages.
+"""
+
+from skin_cancer.profiling import profile_training
+
+PROFILE = False #@param {type:"boolean"}
+
+#profile_training(training_data, custom=True, log_dir=paths["logs"])
 
 """## Training the model"""
 
-NUM_EPOCHS = 50 #@param {type:"slider", min:10, max:100}
+from skin_cancer.training import save_model, train_model
 
-# function to train the model
-def train_model(custom=False):
-  """
-  returns trained model
-  """
-  if custom:
-    model = create_custom_model()
-  else:
-    model = create_model()
-  tensorboard = create_tensorboard_callback()
-  model.fit(x=train_data, 
-            epochs=NUM_EPOCHS, 
-            validation_data=val_data, 
-            validation_freq=1, 
-            callbacks=[tensorboard, early_stopping])
-  return model
-
-def save_model(model, suffix=None):
-  modeldir  = os.path.join("drive/My Drive/SkinCancer/trained_models",
-                           datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
-  model_path = modeldir + "_" + suffix + ".h5"
-  model.save(model_path)
-  print(f"Model saved to: {model_path}")
-  return model_path
+NUM_EPOCHS = 50 #@param {type:"slider", min:10, max:100}
 
 # traning
-#model = train_model(custom=False)
+#model = train_model(training_data, custom=False, checkpoint_dir=paths["checkpoints"], profile=PROFILE,
+#                    epochs=NUM_EPOCHS, patience=PATIENCE, log_dir=paths["logs"])
 
 # save model
-#save_model(model, suffix="resnet")
+#save_model(model, suffix="resnet", model_dir=paths["models"])
 
 # Commented out IPython magic to ensure Python compatibility.
 # %tensorboard --logdir drive/My\ Drive/SkinCancer/logs
 
-"""##Loading a trianed model
+"""### Distributed Training
+train_model takes a tf.distribute strategy, e.g. MultiWorkerMirroredStrategy with one process per node
+and the cluster described in the TF_CONFIG environment variable of every process.
+The scaling benchmark starts local worker processes as stand-ins for nodes, each with its share of the cpu cores,
+and every worker trains the custom model with train_model on its shard of the training data.
+"""
+
+from skin_cancer.distributed import benchmark_scaling
 
+#model = train_model(training_data, custom=False, strategy=tf.distribute.MultiWorkerMirroredStrategy())
+
+#benchmark_scaling(training_data)
+
+"""### Frozen Backbone Training on Cached Embeddings
+With a frozen hub model every epoch computes the same backbone outputs.
+They are computed once, cached in a memory mapped file per image id and only the dense head is trained on them.
 """
 
-# load model
-def load_model(filepath, custom=False):
-  """Loads a trained model"""
-  if custom:
-    model = tf.keras.models.load_model(filepath)
-  else:
-    model = tf.keras.models.load_model(filepath, custom_objects={"KerasLayer":hub.KerasLayer})
-  return model
+from skin_cancer.embeddings import train_head
 
-# execute load model function
-model = load_model("/content/drive/My Drive/SkinCancer/trained_models/20201017-152527_custom_images.h5")
+#model = train_head(training_data, cache_dir=paths["embeddings"], patience=PATIENCE, log_dir=paths["logs"])
 
-# export tfjs model of loaded model
+"""### Hyperparameter Sweep
+Instead of rerunning the training with other slider values, the sweep samples trials from a search space of SIZE, BATCH_SIZE,
+NUM_EPOCHS, PATIENCE, MODEL_URL and the layer widths and dropout of the custom model and trains them on a process pool,
+each trial with THREADS_PER_TRIAL cpu threads. After every rung only the best 1/ETA of the trials continue with ETA times the epochs.
+"""
 
-#!pip install -q tensorflowjs
+from skin_cancer.sweep import SEARCH_SPACE, run_sweep
 
-import tensorflowjs as tfjs
+NUM_TRIALS = 9 #@param {type:"slider", min:3, max:27}
+ETA = 3 #@param {type:"slider", min:2, max:4}
+THREADS_PER_TRIAL = 2 #@param {type:"slider", min:1, max:8}
 
-tfjs.converters.save_keras_model(model, "drive/My Drive/SkinCancer/trained_models")
+#sweep_results = run_sweep(metadata, paths["images"], SEARCH_SPACE, num_trials=NUM_TRIALS, eta=ETA,
+#                          threads_per_trial=THREADS_PER_TRIAL, split_path=paths["split"], sweep_dir=paths["sweeps"])
+#sweep_results
 
-# export tflite model of loaded model
+"""##Loading a trianed model
+
+"""
+
+# execute load model function
+model = load_model("/content/drive/My Drive/SkinCancer/trained_models/20201017-152527_custom_images.h5",
+                   mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE)
 
-# Convert the model.
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-tflite_model = converter.convert()
+"""### Model Registry
+Batch jobs which switch between models get them from a registry, which keeps the loaded models (.h5, SavedModel, TFLite or tfjs)
+in an LRU cache within a memory budget and warms every model up after loading, so the first prediction does not trace the predict function.
+"""
 
-# Save the model.
-with open('scc_model.tflite', 'wb') as f:
-  f.write(tflite_model)
+from skin_cancer.registry import default_registry, get_model
 
-"""## Evaluation and Prediction
+#model = get_model("/content/drive/My Drive/SkinCancer/trained_models/20201017-152527_custom_images.h5")
+#default_registry.report()
 
-### Create Validation Predictions
+"""### Loading the tfjs Model
+The tfjs layers-model of the mobile app (trained_model_v2.json and its weight shards) is loaded without the tensorflowjs converter.
+Its shards are memory mapped and weights are read by name when they are used, e.g. the 7-class head without the MobileNetV2 backbone.
+A retrained head is written back into the shards which contain it, the backbone shards stay untouched.
 """
 
-model.evaluate(val_data)
+from skin_cancer.tfjs_model import TFJSWeights, load_tfjs_model, swap_tfjs_head, tfjs_to_tflite
 
-# create predictions
-val_predictions = model.predict(val_data, verbose=1)
-val_predictions.shape, sum(val_predictions[0])
+#tfjs_weights = TFJSWeights("/content/drive/My Drive/SkinCancer/tfjs_model/trained_model_v2.json")
+#tfjs_weights["dense_1/kernel"].shape
+#tfjs_model = load_tfjs_model("/content/drive/My Drive/SkinCancer/tfjs_model/trained_model_v2.json")
+#swap_tfjs_head("/content/drive/My Drive/SkinCancer/tfjs_model/trained_model_v2.json", model.layers[-1],
+#               output_dir="/content/drive/My Drive/SkinCancer/tfjs_model_new_head")
 
-def prediction_label(prediction, print=False):
-  """Prints label with highest probability for prediction array"""
-  max_index = prediction.argmax()
-  label = classes[max_index]
-  if print:
-    print(f"Predicted label: {label} with {prediction[max_index]}")
-  
-  return label
+# export tfjs model of loaded model
 
-# unbatch data for visualisations
-def breakup_batches(data):
-  """Return seperate lists of images and labels"""
-  images = []
-  labels = []
+#!pip install -q tensorflowjs
 
-  for image, label in val_data.unbatch().as_numpy_iterator():
-    images.append(image)
-    labels.append(classes[np.argmax(label)])
-  return images, labels
+from skin_cancer.export import export_tfjs, export_tflite, quantization_report
 
-val_images, val_labels = breakup_batches(val_data)
+export_tfjs(model, paths["models"])
 
-"""### Validation Data Visualisation"""
+# export tflite model of loaded model
+
+export_tflite(model, "scc_model.tflite")
+
+"""### TFLite Inference
+The predictor keeps a pool of tflite interpreters, one per worker thread, with their input tensors allocated once for batch_size images.
+"""
+
+from skin_cancer.tflite import TFLitePredictor, benchmark_tflite
 
-def plot_prediction(predictions_probs, true_labels, images, n=1):
-  """View the prediction """
-  pred_prob, true_label, image = predictions_probs[n], true_labels[n], images[n]
+#benchmark_tflite(model, "scc_model.tflite", val_data)
 
-  pred_label = prediction_label(pred_prob)
+"""### TFLite Quantization
+Each quantized export is compared to the float keras model in size, cpu latency, validation accuracy and confusion matrix.
+"""
 
-  plt.imshow(image)
-  plt.xticks([])
-  plt.yticks([])
+#report = quantization_report(model, val_data, y_val, X_val)
+#report.loc[report["meets_target"]].sort_values(["size_mb", "latency_ms"])
 
-  if pred_label == true_label:
-    color = "green"
-  else:
-    color = "red"
+"""## Evaluation and Prediction
 
-  plt.title("Pred: {} {:2.0f}%, True: {}".format(classnames[pred_label],
-                                    np.max(pred_prob)*100,
-                                    true_label),
-                                    color = color)
+### Test Time Augmentation
+Every batch is expanded into k flipped and cropped views inside the graph and predicted in one forward pass.
+The probabilities of the views of each image are reduced to one prediction.
+"""
 
-def top_preds(prediction_probs, labels, n=1):
-  """top 10 highest preds"""
-  pred_prob, true_label = prediction_probs[n], labels[n]
+from skin_cancer.evaluation import THUMBNAIL_SIZE, compare_decode_modes, evaluate_model
 
-  pred_label = prediction_label(pred_prob)
-  top_indexes = pred_prob.argsort()[-10:][::-1]
-  top_preds = pred_prob[top_indexes]
-  top_labels = classes[top_indexes]
+TTA_VIEWS = 1 #@param {type:"slider", min:1, max:9}
+TTA_REDUCTION = "mean" #@param ["mean", "max", "gmean"]
 
-  top_plot = plt.bar(np.arange(len(top_labels)),
-                               top_preds,
-                               color = "grey")
-  plt.xticks(np.arange(len(top_labels)),
-             labels=top_labels,
-             rotation ="vertical")
-  if np.isin(true_label, top_labels):
-    top_plot[np.argmax(top_labels == true_label)].set_color("green")
+"""### Create Validation Predictions"""
 
-plot_prediction(val_predictions, val_labels, val_images, 23)
+# evaluate and create predictions in a single pass over the validation data
+val_results = evaluate_model(model, val_data, keep="thumbnails", tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION)
+val_predictions = val_results["probabilities"]
+val_predictions.shape, sum(val_predictions[0])
+
+# images and true labels for visualisations
+val_images = val_results["images"]
+val_labels = classes[val_results["labels"]]
+
+"""### Validation Data Visualisation"""
 
-def plot_predicion_distributions(predicions, true_labels, images, i_start=0):
-  """Plots multiple image, prediction distribution pairs. Starts Data at i_start"""
-  rows = 3
-  cols = 2
-  num_img = rows*cols
-  plt.figure(figsize=(10*cols, 5*rows))
-  for i in range(num_img):
-    plt.subplot(rows, 2*cols, 2*i+1)
-    plot_prediction(predicions, true_labels, images, n=i+i_start)
-    plt.subplot(rows, 2*cols, 2*i+2)
-    top_preds(predicions, true_labels, i+i_start)
-  plt.tight_layout()
-  plt.show()
+plot_prediction(val_predictions, val_labels, val_images, 23)
 
 plot_predicion_distributions(val_predictions, val_labels, val_images)
 
 """### Confusion Matrix"""
 
-from sklearn.metrics import confusion_matrix
-import seaborn as sn
-val_prediction_labels = [prediction_label(prediction) for prediction in val_predictions]
-cm = confusion_matrix(y_true=val_labels, y_pred=val_prediction_labels)
-df_cm = pd.DataFrame(cm, index = classes, columns = classes)
-plt.figure(figsize=(10,7))
-sn.heatmap(df_cm, annot=True,  fmt="d")
-plt.title("Validation Data Confusion Matrix")
-plt.ylabel("True label")
-plt.xlabel("Predicted label")
-plt.show()
+plot_confusion_matrix(val_results["confusion_matrix"])
+
+"""### Decode Mode Comparison
+Compares the decode throughput and validation metrics of the decode modes before one of them is used as DECODE_MODE.
+"""
+
+#compare_decode_modes(model, X_val, y_val)
 
 """### Create Test Predictions"""
 
 #!unzip "/content/drive/My Drive/SkinCancer/ISIC2018_Task3_Test_Input.zip" -d "/content/drive/My Drive/SkinCancer/test_data"
 
+from skin_cancer.prediction import image_ids, list_images, predict_directory
+
 # load test image files
-test_path = "drive/My Drive/SkinCancer/test_data/"
-test_filenames = [test_path +fname for fname in os.listdir(test_path)]
+test_filenames = list_images(paths["test_images"])
 test_filenames[:5]
 
-# create test data batches
-test_data = create_batches(test_filenames)
+# predictions of images seen before by the same model and preprocessing are read from the prediction cache,
+# which is keyed by the content of the jpeg files and keeps the least recently used predictions within MAX_CACHE_MB
+from skin_cancer.prediction_cache import PredictionCache
+
+USE_PREDICTION_CACHE = False #@param {type:"boolean"}
+MAX_CACHE_MB = 256 #@param {type:"number"}
+prediction_cache = PredictionCache(paths["prediction_cache"], MAX_CACHE_MB) if USE_PREDICTION_CACHE else None
+
+# make test predictions and save the prediction csv batch by batch
+predict_directory(model, test_filenames, paths["predictions"], tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION,
+                  cache=prediction_cache)
 
-# make test predictions
-test_predictions = model.predict(test_data, verbose=1)
+# load test predictions
+test_preds = pd.read_csv(paths["predictions"], index_col="IMG_ID")
+test_predictions = test_preds.loc[image_ids(test_filenames), classes].values
 
 test_predictions[0]
 
 """### Visualize Test predictions"""
 
-def plot_test_predictions(predicted_labels, predictions, images):
-  """Plots images and their predicted labels"""
-  i_start = 90
-  rows = 3
-  cols = 10
-  num_img = rows*cols
-  plt.figure(figsize=(2*cols, 2.5*rows))
-  for i in range(num_img):
-    plt.subplot(rows, cols, i+1)
-    plt.xticks([])
-    plt.yticks([])
-    plt.title("{} {:2.0f}%".format(predicted_labels[i],
-                                  np.max(predictions[i])*100))
-    plt.imshow(images[i])
-  plt.show()
+# predict the plotted test images and keep their thumbnails in a single pass
+NUM_PLOTTED = 30
+test_data = create_batches(test_filenames[:NUM_PLOTTED])
+test_results = evaluate_model(model, test_data, keep="thumbnails")
+test_images = test_results["images"]
 
 # get test prediction labels
-test_labels = [prediction_label(test_predictions[i]) for i in range(len(test_predictions))]
+test_labels = classes[test_results["probabilities"].argmax(axis=1)]
 
-# get test images
-test_images = []
-for image in test_data.unbatch().as_numpy_iterator():
-  test_images.append(image)
-
-plot_test_predictions(test_labels, test_predictions, test_images)
+plot_test_predictions(test_labels, test_results["probabilities"], test_images)
 
 # create "test" as truth labels
-test_truth = ["test" for i in range(len(test_predictions))]
+test_truth = ["test" for i in range(len(test_images))]
 
-plot_predicion_distributions(test_predictions, test_truth, test_images)
+plot_predicion_distributions(test_results["probabilities"], test_truth, test_images)
 
-"""### Save test predictions"""
+"""### Test predictions csv"""
 
-# generate prediction csv
 pd.options.display.float_format = '{:.4f}'.format
-test_preds = pd.DataFrame(test_predictions)
-test_preds.columns = classes
-test_preds.insert(0, 'IMG_ID', [os.path.splitext(path)[0] for path in os.listdir(test_path)])
 test_preds.head()
 
-# save prediction csv
-test_preds.to_csv("drive/My Drive/SkinCancer/test_predictions.csv")
-
 """### Custom Data Predictions"""
 
 # get filenames
-custom_path = "drive/My Drive/SkinCancer/custom_data/"
-custom_filenames = [custom_path +fname for fname in os.listdir(custom_path)]
+custom_filenames = list_images(paths["custom_images"])
 custom_filenames
 
-# batch data
-custom_data = create_batches(custom_filenames)
+# predict the custom images like the test images, with the same test time augmentation and prediction cache
+predict_directory(model, custom_filenames, paths["custom_predictions"], tta=TTA_VIEWS, tta_reduction=TTA_REDUCTION,
+                  cache=prediction_cache)
+custom_preds = pd.read_csv(paths["custom_predictions"], index_col="IMG_ID")
+custom_predictions = custom_preds.loc[image_ids(custom_filenames), classes].values
 
-# predictions
-custom_predictions = model.predict(custom_data)
+# thumbnails of the custom images for plotting
+custom_data = create_batches(custom_filenames)
+custom_images = np.concatenate([tf.image.convert_image_dtype(tf.image.resize(images, [THUMBNAIL_SIZE, THUMBNAIL_SIZE]),
+                                                             tf.uint8, saturate=True).numpy()
+                                for images in custom_data])
 custom_predictions[0]
 
 # prediction labels
-custom_labels = [prediction_label(custom_predictions[i]) for i in range(len(custom_predictions))]
+custom_labels = classes[custom_predictions.argmax(axis=1)]
 
 # create "custom" as truth labels
-custom_truth = ["custom" for i in range(len(test_predictions))]
-
-# get images
-custom_images = []
-for image in custom_data.unbatch().as_numpy_iterator():
-  custom_images.append(image)
+custom_truth = ["custom" for i in range(len(custom_predictions))]
 
 plot_test_predictions(custom_labels, custom_predictions, custom_images)
 
 plot_predicion_distributions(custom_predictions, custom_truth, custom_images)
 
+"""## Serving the Model
+A small local http server predicts posted jpeg images.
+Concurrent requests are collected into one batch until the batch is full or the oldest request waited max_latency_ms, so every batch needs a single forward pass.
+"""
+
+from skin_cancer.serving import serve_model
+
+# serve the loaded model or the exported tflite model
+#serve_model(model, max_batch_size=32, max_latency_ms=10)
+#serve_model("scc_model.tflite")
+
+"""## Import Time Benchmark
+Starts the package, the cli and a prediction with the cli in new interpreters and reports their startup time
+and which of TensorFlow, tensorflow_hub, tensorflowjs, matplotlib and seaborn they load.
+"""
+
+from skin_cancer.import_benchmark import benchmark_imports
+
+#benchmark_imports()
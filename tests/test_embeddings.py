@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from skin_cancer import embeddings
+from skin_cancer.pipeline import create_batches
+
+def write_images(directory, prefix, num_images, seed):
+  """Writes num_images random jpegs and returns their filepaths"""
+  rng = np.random.default_rng(seed)
+  filepaths = []
+  for i in range(num_images):
+    filepath = str(directory / f"{prefix}_{i:03d}.jpg")
+    image = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    tf.io.write_file(filepath, tf.io.encode_jpeg(image))
+    filepaths.append(filepath)
+  return filepaths
+
+def test_cached_embeddings_grows_cache(tmp_path, monkeypatch):
+  # a copy chunk which does not divide the cached rows
+  monkeypatch.setattr(embeddings, "COPY_ROWS", 32)
+  first = write_images(tmp_path, "first", 40, seed=0)
+  second = write_images(tmp_path, "second", 40, seed=1)
+  backbone = tf.keras.Sequential([tf.keras.Input((224, 224, 3)), tf.keras.layers.GlobalAveragePooling2D()])
+  cache_dir = tmp_path / "cache"
+
+  first_embeddings = embeddings.cached_embeddings(first, backbone, "key", str(cache_dir), batch_size=16)
+  second_embeddings = embeddings.cached_embeddings(second, backbone, "key", str(cache_dir), batch_size=16)
+
+  expected = backbone.predict(create_batches(first + second, size=16), verbose=0)
+  np.testing.assert_allclose(first_embeddings, expected[:40], atol=1e-5)
+  np.testing.assert_allclose(second_embeddings, expected[40:], atol=1e-5)
+  stored = np.load(cache_dir / "key.npy")
+  ids = pd.read_csv(cache_dir / "key-ids.csv")["image_id"].tolist()
+  assert ids == embeddings.filepath_ids(first + second)
+  np.testing.assert_allclose(stored, expected, atol=1e-5)